@@ -7,6 +7,7 @@ PREFIX2 = "!!cbr"
 VERSION = "0.2.7-dev032"
 LIB_VERSION = "v20210915"
 CLIENT_TYPE = "mc"
+CAPABILITIES = {"batch": True, "protocol": 2, "keepalive": True}
 
 ADVANCED_CONFIG_PATH = "advanced_config.json"
 
@@ -24,6 +25,9 @@ DEFAULT_ADVANCED_CONFIG = {
     "size_to_zip_chat": 512,  # kb
     "disable_chat_log": True,
     "split_chat_log": False,
+    "batch_window": 0,  # ms, 0 to disable
+    "batch_bytes": 16384,
+    "max_frame_size": 4194304,  # bytes
     "auto_restart": True  # not recommend to change
 }
 
@@ -26,6 +26,9 @@ class AdvancedConfig:
         self.size_to_zip_path = DEFAULT_ADVANCED_CONFIG["size_to_zip_chat"]
         self.disable_chat_log = DEFAULT_ADVANCED_CONFIG["disable_chat_log"]
         self.split_chat_log = DEFAULT_ADVANCED_CONFIG["split_chat_log"]
+        self.batch_window = DEFAULT_ADVANCED_CONFIG["batch_window"]
+        self.batch_bytes = DEFAULT_ADVANCED_CONFIG["batch_bytes"]
+        self.max_frame_size = DEFAULT_ADVANCED_CONFIG["max_frame_size"]
         self.auto_restart = DEFAULT_ADVANCED_CONFIG["auto_restart"]
 
     def load_advanced_config(self):
@@ -65,6 +68,9 @@ class AdvancedConfig:
         self.size_to_zip_path = config_dict["size_to_zip_chat"]
         self.disable_chat_log = config_dict["disable_chat_log"]
         self.split_chat_log = config_dict["split_chat_log"]
+        self.batch_window = config_dict["batch_window"]
+        self.batch_bytes = config_dict["batch_bytes"]
+        self.max_frame_size = config_dict["max_frame_size"]
 
 
 class Config(AdvancedConfig):
@@ -1,10 +1,10 @@
-import json
 import threading
 import time
 
 from typing import TYPE_CHECKING
 
 from chatbridgereforged_mc.constants import *
+from chatbridgereforged_mc.utils import ping_formatter
 if TYPE_CHECKING:
     from chatbridgereforged_mc.lib.logger import CBRLogger
     from chatbridgereforged_mc.net.tcpclient import CBRTCPClient
@@ -54,14 +54,28 @@ class PingGuardian(GuardianBase):
         super().__init__(logger, "ping")
         self.client = client_class
         self.config = config
+        self.interval = config.ping_time
+        self.wakeup = threading.Event()
+
+    def set_interval(self, interval):
+        """
+            interval negotiated with the server at login
+        """
+        self.interval = interval
+        self.wakeup.set()
+
+    def stop(self):
+        super().stop()
+        self.wakeup.set()
 
     def wait_restart(self):
         self.logger.debug("keep alive")
-        for i in range(self.config.ping_time):
-            time.sleep(1)
-            if self.end:
-                return
-        ping_msg = json.dumps({"action": "keepAlive", "type": "ping"})
+        if self.wakeup.wait(self.interval):
+            self.wakeup.clear()
+            return
+        if self.end:
+            return
+        ping_msg = ping_formatter()
         if self.client.connected:
             self.client.send_msg(self.client.socket, ping_msg)
 
@@ -1,10 +1,13 @@
+import json
 import socket as soc
-import struct
+import threading
 
 from typing import TYPE_CHECKING
 
-from chatbridgereforged_mc.net.encrypt import AESCryptor
-from chatbridgereforged_mc.utils import login_formatter, msg_json_formatter, ping_formatter, stop_formatter
+from chatbridgereforged_mc.net.encrypt import AESCryptor, CIPHER_CBC
+from chatbridgereforged_mc.net.frame import decode_v2, encode_v2, encode_v2_batch, is_v2, FrameCompressor, FrameDecoder, FrameTooLargeError, FLAG_ENCRYPTED, HEADER, PROTOCOL_V1, \
+    PROTOCOL_V2, READ_SIZE
+from chatbridgereforged_mc.utils import batch_formatter, login_formatter, msg_json_formatter, ping_formatter, stop_formatter
 
 if TYPE_CHECKING:
     from chatbridgereforged_mc.net.tcpclient import CBRTCPClient
@@ -14,33 +17,132 @@ class NetworkBase(AESCryptor):
     def __init__(self, key, new_client: "CBRTCPClient"):
         super().__init__(key, logger=new_client.logger)
         self.client = new_client
+        self.max_frame_size = new_client.config.max_frame_size
+        self.send_lock = threading.Lock()
+        self.batch_lock = threading.Lock()
+        self.batch = []
+        self.batch_size = 0
+        self.batch_timer = None
+        self.compressor = None
+        self.cipher = self.ciphers.get(CIPHER_CBC)
+        # all ciphers before login, then only the negotiated one, so frames can not be downgraded
+        self.accepted_ciphers = self.frame_ciphers
 
-    def receive_msg(self, socket: soc.socket, address):
-        data = socket.recv(4)
-        if len(data) < 4:
-            self.logger.error("Data length error")
-            return "{}"
-        length = struct.unpack("I", data)[0]
-        msg = socket.recv(length)
-        try:
-            msg = self.decrypt(msg)
-        except Exception:
-            self.logger.bug_log()
-            return "{}"
-        self.logger.debug(f"Received {msg!r} from {address!r}")
-        return msg
-
-    def send_msg(self, socket: soc.socket, msg, target=""):
+    def receive_msg(self, socket: soc.socket, address, decoder: FrameDecoder):
+        frames = []
+        while not frames:
+            data = socket.recv(READ_SIZE)
+            if not data:
+                raise ConnectionAbortedError("Connection closed by server")
+            frames = decoder.feed(data)
+        msgs = []
+        for frame in frames:
+            try:
+                msg = self.decode_frame(frame)
+            except FrameTooLargeError:
+                raise
+            except Exception:
+                self.logger.bug_log()
+                msg = {}
+            self.logger.debug(f"Received {msg!r} from {address!r}")
+            msgs.append(msg)
+        return msgs
+
+    def decode_frame(self, frame: bytes):
+        if is_v2(frame):
+            return decode_v2(frame, self.accepted_ciphers, self.max_frame_size)
+        if len(self.ciphers) != 0 and FLAG_ENCRYPTED not in self.accepted_ciphers.keys():
+            # v1 is cbc, it is a downgrade if another cipher is negotiated
+            raise ValueError("Frame of protocol v1 is not accepted with the negotiated cipher")
+        return json.loads(self.decrypt(frame))
+
+    def get_protocol(self):
+        return self.client.capabilities.get("protocol", PROTOCOL_V1)
+
+    def set_capabilities(self, capabilities: dict, negotiated=True):
+        """
+            apply the capabilities from login result, compression and cipher are only used with protocol v2
+
+            negotiated is False to reset them before login
+        """
+        self.client.capabilities = capabilities
+        self.cipher = self.ciphers.get(capabilities.get("cipher", CIPHER_CBC))
+        self.accepted_ciphers = self.frame_ciphers
+        if negotiated:
+            self.accepted_ciphers = {self.cipher.flag: self.cipher} if self.cipher is not None else {}
+        self.compressor = None
+        if "compression" in capabilities.keys():
+            self.compressor = FrameCompressor(**capabilities["compression"])
+        if "keepalive" in capabilities.keys():
+            self.client.ping_guardian.set_interval(capabilities["keepalive"]["interval"])
+            self.client.socket.settimeout(capabilities["keepalive"]["timeout"])
+
+    def send_msg(self, socket: soc.socket, msg, target="", batch=True):
         if not self.client.connected:
             self.logger.debug("Not connected to the server")
             return
         if target != "":
             target = "to " + target
         self.logger.debug(f"Send: {msg!r} {target}")
-        msg = self.encrypt(msg)
-        msg = struct.pack("I", len(msg)) + msg
+        if batch and self.client.config.batch_window > 0 and self.client.capabilities.get("batch", False):
+            self.add_batch(socket, msg)
+        else:
+            self.flush_batch(socket)
+            self.send_frame(socket, msg)
+
+    def add_batch(self, socket: soc.socket, msg):
+        # keep the encoded message, so it is only encrypted once with the whole batch
+        if self.get_protocol() == PROTOCOL_V2:
+            part = encode_v2(msg)
+        else:
+            part = json.dumps(msg)
+        with self.batch_lock:
+            self.batch.append((msg, part))
+            self.batch_size += len(part)
+            if self.batch_size < self.client.config.batch_bytes:
+                if self.batch_timer is None:
+                    self.batch_timer = threading.Timer(self.client.config.batch_window / 1000, self.flush_batch, args=(socket,))
+                    self.batch_timer.daemon = True
+                    self.batch_timer.start()
+                return
+            msgs = self.__take_batch()
+        self.send_batch(socket, msgs)
+
+    def flush_batch(self, socket: soc.socket):
+        with self.batch_lock:
+            msgs = self.__take_batch()
+        if len(msgs) == 1:
+            self.send_frame(socket, msgs[0][0])
+        elif len(msgs) > 1:
+            self.send_batch(socket, msgs)
+
+    def __take_batch(self):
+        msgs = self.batch
+        self.batch = []
+        self.batch_size = 0
+        if self.batch_timer is not None:
+            self.batch_timer.cancel()
+            self.batch_timer = None
+        return msgs
+
+    def send_batch(self, socket: soc.socket, msgs: list):
+        parts = [i[1] for i in msgs]
+        if self.get_protocol() == PROTOCOL_V2:
+            self.send_data(socket, encode_v2_batch(parts, self.cipher, self.compressor))
+        else:
+            self.send_data(socket, self.encrypt(batch_formatter(parts)))
+
+    def send_frame(self, socket: soc.socket, msg: dict):
+        if self.get_protocol() == PROTOCOL_V2:
+            self.send_data(socket, encode_v2(msg, self.cipher, self.compressor))
+        else:
+            self.send_data(socket, self.encrypt(json.dumps(msg)))
+
+    def send_data(self, socket: soc.socket, data: bytes):
+        msg = HEADER.pack(len(data)) + data
         try:
-            socket.sendall(msg)
+            with self.send_lock:
+                socket.sendall(msg)
         except BrokenPipeError:
             self.logger.info("Connection closed from server")
             self.client.connected = False
@@ -57,12 +159,13 @@ class Network(NetworkBase):
 
     def send_ping(self, socket, pong=False, target=""):
         msg = ping_formatter(pong)
-        self.send_msg(socket, msg, target)
+        # not held for batch_window, the server measures round trip time with it
+        self.send_msg(socket, msg, target, batch=False)
 
     def send_login(self, socket, name, password, target=""):
         msg = login_formatter(name, password)
-        self.send_msg(socket, msg, target)
+        self.send_msg(socket, msg, target, batch=False)
 
     def send_stop(self, socket, target=""):
         msg = stop_formatter()
-        self.send_msg(socket, msg, target)
+        self.send_msg(socket, msg, target, batch=False)
@@ -105,6 +105,8 @@ class ClientProcess:
             if msg["action"] == "result":
                 if msg["result"] == "login success":
                     self.logger.info("Login Success")
+                    if "capabilities" in msg.keys():
+                        self.client.set_capabilities(msg["capabilities"])
                 else:
                     self.logger.error("Login in fail")
             elif msg["action"] == "keepAlive":
@@ -148,6 +150,11 @@ class ClientProcess:
                     self.client.server.execute(f"execute run tellraw {receiver} {message}")
                 else:
                     self.client.server.execute(f"execute run tellraw @a {message}")
+            elif msg["action"] == "batch":
+                for i in msg["messages"]:
+                    self.process_msg(i, socket)
+                    if not self.client.connected:
+                        return
             elif msg["action"] == "stop":
                 self.client.close_connection()
                 self.logger.info(f"Connection closed from server")
@@ -169,7 +176,7 @@ class ClientProcess:
                         msg["result"]["type"] = 2
                 else:
                     msg["result"]["type"] = 2
-                self.client.send_msg(socket, json.dumps(msg))
+                self.client.send_msg(socket, msg)
             elif msg["action"] == "api":
                 plugin_id = msg["plugin"]
                 function = msg["function"]
@@ -194,7 +201,7 @@ class ClientProcess:
                                 msg["result"]["result"] = result
                 else:
                     msg["result"]["type"] = 3
-                self.client.send_msg(socket, json.dumps(msg))
+                self.client.send_msg(socket, msg)
         else:
             self.logger.error(f"Receive Unresolved message from server")
             self.logger.info(f"Close Connection to server")
@@ -1,4 +1,3 @@
-import json
 import socket as soc
 import threading
 import time
@@ -6,6 +5,7 @@ import time
 from chatbridgereforged_mc.lib.config import Config
 from chatbridgereforged_mc.lib.guardian import PingGuardian, RestartGuardian
 from chatbridgereforged_mc.lib.logger import CBRLogger
+from chatbridgereforged_mc.net.frame import FrameDecoder, FrameTooLargeError
 from chatbridgereforged_mc.net.network import Network
 from chatbridgereforged_mc.net.process import ClientProcess
 from chatbridgereforged_mc.constants import *
@@ -17,6 +17,8 @@ class CBRTCPClient(Network):
         self.logger = logger
         self.server: PluginServerInterface = server
         self.socket = None
+        self.decoder = FrameDecoder(config.max_frame_size)
+        self.capabilities = {}
         self.connected = False
         self.cancelled = False
         self.connecting = False
@@ -55,6 +57,8 @@ class CBRTCPClient(Network):
         self.logger.print_msg(f"Connecting to server '{self.config.host_name}:{self.config.host_port}' with client name {self.name}", 2, info=info, server=self.server)
         self.logger.info(f"version : {VERSION}, lib version : {LIB_VERSION}")
         self.socket = soc.socket()
+        self.decoder = FrameDecoder(self.config.max_frame_size)
+        self.set_capabilities({}, False)
         try:
             self.socket.connect((self.config.host_name, self.config.host_port))
         except Exception:
@@ -104,13 +108,15 @@ class CBRTCPClient(Network):
 
     def client_process(self):
         try:
-            msg = self.receive_msg(self.socket, self.config.host_name)
+            msgs = self.receive_msg(self.socket, self.config.host_name, self.decoder)
         except OSError as er:
             self.logger.debug("Stop Receive message")
             self.connected = False
             raise er
-        msg = json.loads(msg)
-        self.process.process_msg(msg, self.socket)
+        for msg in msgs:
+            self.process.process_msg(msg, self.socket)
+            if not self.connected:
+                break
 
     def handle_echo(self):
         self.send_login(self.socket, self.name, self.password, "server")
@@ -127,6 +133,10 @@ class CBRTCPClient(Network):
                 self.logger.info("Connection closed")
                 self.logger.bug_log(False)
                 break
+            except FrameTooLargeError as err:
+                self.logger.error(f"{err}, disconnect from server")
+                self.socket.close()
+                break
             except Exception:
                 self.logger.debug("Cancel Process")
                 if not self.cancelled:
@@ -2,7 +2,9 @@ import json
 
 from mcdreforged.api.all import *
 
-from chatbridgereforged_mc.constants import LIB_VERSION, CLIENT_TYPE
+from chatbridgereforged_mc.constants import LIB_VERSION, CLIENT_TYPE, CAPABILITIES
+from chatbridgereforged_mc.net.encrypt import CIPHER_CBC, CIPHER_CTR_HMAC
+from chatbridgereforged_mc.net.frame import CODECS
 
 
 def rtext_cmd(txt, msg, cmd):
@@ -23,7 +25,7 @@ def msg_json_formatter(client_name, player, msg):
         "player": player,
         "message": msg
     }
-    return json.dumps(message)
+    return message
 
 
 def ping_formatter(pong=False):
@@ -34,7 +36,7 @@ def ping_formatter(pong=False):
         message.update({"type": "pong"})
     else:
         message.update({"type": "ping"})
-    return json.dumps(message)
+    return message
 
 
 def login_formatter(name, password):
@@ -43,11 +45,17 @@ def login_formatter(name, password):
         "name": name,
         "password": password,
         "lib_version": LIB_VERSION,
-        "type": CLIENT_TYPE
+        "type": CLIENT_TYPE,
+        "capabilities": dict(CAPABILITIES, compression=list(CODECS), cipher=[CIPHER_CBC, CIPHER_CTR_HMAC])
     }
-    return json.dumps(message)
+    return message
 
 
 def stop_formatter():
     message = {"action": "stop"}
-    return json.dumps(message)
+    return message
+
+
+def batch_formatter(msgs: list):
+    # msgs are json strings already, join them instead of dumps again
+    return '{"action": "batch", "messages": [' + ", ".join(msgs) + "]}"
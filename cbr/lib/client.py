@@ -1,5 +1,20 @@
 import trio
 
+from cbr.net.rtt import RTTStats
+
+
+class PendingResult:
+    """
+        Result of a command or api query, waiting for the reply from client
+    """
+    def __init__(self):
+        self.event = trio.Event()
+        self.result = None
+
+    def set(self, result):
+        self.result = result
+        self.event.set()
+
 
 class Client:
     def __init__(self, name, password):
@@ -9,9 +24,47 @@ class Client:
         self.type = False
         self.stream = None
         self.send_lock = trio.Lock()
-        self.ping = None
-        self.ping_lock = trio.CancelScope()
-        self.cmd_lock = trio.CancelScope()
-        self.cmd_result = None
+        self.queue = None
+        self.rtt = RTTStats()
+        # pongs come back in the order of pings, so the count of pongs tells which ping is answered
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.probe = None
+        self.pong_time = 0
+        self.pending = {}
         self.process = None
         self.lib_version = None
+        self.capabilities = {}
+
+    def resolve(self, request_id, result):
+        """
+            resolve the query of request_id, the reply from old clients has no id so it goes to the oldest query
+        """
+        if request_id is None:
+            if len(self.pending) == 0:
+                return False
+            request_id = next(iter(self.pending))
+        pending = self.pending.pop(request_id, None)
+        if pending is None:
+            return False
+        pending.set(result)
+        return True
+
+    def cancel_pending(self):
+        for pending in self.pending.values():
+            pending.set(None)
+        self.pending.clear()
+
+    def reset_ping(self):
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.probe = None
+
+    def on_pong(self):
+        """
+            only the pong of the ping in probe sets its event, pongs of keepalive pings are skipped
+        """
+        self.pongs_received += 1
+        if self.probe is not None and self.probe[0] == self.pongs_received:
+            self.pong_time = trio.current_time()
+            self.probe[1].set()
@@ -42,6 +42,57 @@ CONFIG_STRUCTURE = [
      ]
      }
 ]
+DEFAULT_NETWORK_CONFIG = {
+    "send_queue_size": 256,
+    "slow_client_policy": "drop",
+    "slow_client_timeout": 10,
+    "send_timeout": 5,
+    "batch_window": 0,
+    "batch_bytes": 16384,
+    "protocol_v2": True,
+    "compress_codec": "zlib",
+    "compress_level": 6,
+    "compress_threshold": 256,
+    "cipher": "cbc",
+    "crypto_thread_threshold": 16384,
+    "crypto_threads": 4,
+    "max_frame_size": 4194304,
+    "rtt_interval": 10,
+    "rtt_timeout": 2,
+    "keepalive_idle": 30,
+    "keepalive_timeout": 90,
+    "presence_interval": 300,
+}
+# type and minimum of numbers in network, minimum is None if any number is fine, seconds can be float
+NETWORK_NUMBERS = {
+    "send_queue_size": (int, 0),
+    "slow_client_timeout": (float, 0),
+    "send_timeout": (float, 0),
+    "batch_window": (float, 0),
+    "batch_bytes": (int, 1),
+    "compress_level": (int, None),
+    "compress_threshold": (int, 0),
+    "crypto_thread_threshold": (int, 0),
+    "crypto_threads": (int, 0),
+    "max_frame_size": (int, 1),
+    "rtt_interval": (float, None),
+    "rtt_timeout": (float, 0),
+    "keepalive_idle": (float, 0),
+    "keepalive_timeout": (float, 0),
+    "presence_interval": (float, None),
+}
+NETWORK_CHOICES = {
+    "slow_client_policy": ("drop", "disconnect"),
+    "compress_codec": ("zlib", "zstd", "none"),
+    "cipher": ("cbc", "ctr-hmac"),
+}
+DEFAULT_PLUGIN_CONFIG = {
+    "max_threads": 4,
+    "max_queued": 32,
+    "auto_reload": False,
+    "watch_interval": 2,
+    "watch_debounce": 0.5,
+}
 
 
 class ConfigChecker:
@@ -133,6 +184,8 @@ class Config:
         self.lib_version = LIB_VERSION
         self.raw_data = {}
         self.clients = []
+        self.network = dict(DEFAULT_NETWORK_CONFIG)
+        self.plugin = dict(DEFAULT_PLUGIN_CONFIG)
 
     def __init_data(self):
         try:
@@ -144,6 +197,56 @@ class Config:
             self.logger.debug_all = self.raw_data["debug"]["all"]
         except AttributeError:
             exit(0)
+        self.network = self.__init_optional_data("network", DEFAULT_NETWORK_CONFIG)
+        self.plugin = self.__init_optional_data("plugin", DEFAULT_PLUGIN_CONFIG)
+        self.__check_network_data()
+        self.__check_plugin_data()
+
+    def __check_network_data(self):
+        # a wrong value should not crash when the first client connects, or work as another one silently
+        for name, (number_type, minimum) in NETWORK_NUMBERS.items():
+            value = self.network[name]
+            types = (int, float) if number_type is float else int
+            if isinstance(value, bool) or not isinstance(value, types):
+                kind = "a number" if number_type is float else "an integer"
+                self.logger.error(f"Config network.{name} should be {kind}, use default value {DEFAULT_NETWORK_CONFIG[name]}")
+                self.network[name] = DEFAULT_NETWORK_CONFIG[name]
+            elif minimum is not None and value < minimum:
+                self.logger.error(f"Config network.{name} should be at least {minimum}, use {minimum}")
+                self.network[name] = minimum
+        for name, choices in NETWORK_CHOICES.items():
+            if self.network[name] not in choices:
+                self.logger.error(f"Config network.{name} should be one of {', '.join(choices)}, use default value {DEFAULT_NETWORK_CONFIG[name]}")
+                self.network[name] = DEFAULT_NETWORK_CONFIG[name]
+        if not isinstance(self.network["protocol_v2"], bool):
+            self.logger.error(f"Config network.protocol_v2 should be true or false, use default value {DEFAULT_NETWORK_CONFIG['protocol_v2']}")
+            self.network["protocol_v2"] = DEFAULT_NETWORK_CONFIG["protocol_v2"]
+
+    def __check_plugin_data(self):
+        # a plugin can not run sync events without any thread
+        for name, minimum in (("max_threads", 1), ("max_queued", 0)):
+            value = self.plugin[name]
+            if isinstance(value, bool) or not isinstance(value, int):
+                self.logger.error(f"Config plugin.{name} should be an integer, use default value {DEFAULT_PLUGIN_CONFIG[name]}")
+                self.plugin[name] = DEFAULT_PLUGIN_CONFIG[name]
+            elif value < minimum:
+                self.logger.error(f"Config plugin.{name} should be at least {minimum}, use {minimum}")
+                self.plugin[name] = minimum
+
+    def __init_optional_data(self, name, default: dict):
+        data = dict(default)
+        if name not in self.raw_data.keys() or self.raw_data[name] is None:
+            self.logger.warning(f"Config {name} not exist in config.yml, use default value")
+            return data
+        if not isinstance(self.raw_data[name], dict):
+            self.logger.error(f"Config {name} in config.yml should be a mapping, use default value")
+            return data
+        for i in default.keys():
+            if i in self.raw_data[name].keys():
+                data[i] = self.raw_data[name][i]
+            else:
+                self.logger.warning(f"Config {name}.{i} not exist in config.yml, use default value {default[i]}")
+        return data
 
     def init_config(self, logger: "CBRLogger"):
         self.logger = logger
@@ -1,4 +1,6 @@
 import hashlib
+import hmac
+import os
 import zlib
 
 from binascii import b2a_base64, a2b_base64
@@ -6,6 +8,63 @@ from Cryptodome.Cipher import AES
 from Cryptodome.Util.Padding import pad, unpad
 
 from cbr.lib.logger import CBRLogger
+from cbr.net.frame import decompress, CODEC_ZLIB, DEFAULT_MAX_FRAME_SIZE, FLAG_AUTHENTICATED, FLAG_ENCRYPTED
+
+CIPHER_CBC = "cbc"
+CIPHER_CTR_HMAC = "ctr-hmac"
+
+
+class CBCCipher:
+    """
+        Legacy mode, the key is used as iv, same as protocol v1
+    """
+    flag = FLAG_ENCRYPTED
+
+    def __init__(self, key: bytes):
+        self.key = key
+
+    def encrypt(self, data: bytes, header=b""):
+        return AES.new(self.key, AES.MODE_CBC, self.key).encrypt(pad(data, 16))
+
+    def decrypt(self, data: bytes, header=b""):
+        return unpad(AES.new(self.key, AES.MODE_CBC, self.key).decrypt(data), 16)
+
+
+class CTRHMACCipher:
+    """
+        AES-CTR with a random nonce for every message, then HMAC-SHA256 of frame header, nonce and ciphertext
+
+        No padding is needed, the hmac key is only hashed once and copied for every message
+    """
+    flag = FLAG_ENCRYPTED | FLAG_AUTHENTICATED
+    NONCE_SIZE = 12
+    TAG_SIZE = 16
+
+    def __init__(self, key: bytes):
+        self.key = hashlib.sha256(b"CBR ctr " + key).digest()
+        self.mac = hmac.new(hashlib.sha256(b"CBR hmac " + key).digest(), digestmod=hashlib.sha256)
+
+    def __tag(self, header: bytes, nonce: bytes, data: bytes):
+        mac = self.mac.copy()
+        mac.update(header)
+        mac.update(nonce)
+        mac.update(data)
+        return mac.digest()[:self.TAG_SIZE]
+
+    def encrypt(self, data: bytes, header=b""):
+        nonce = os.urandom(self.NONCE_SIZE)
+        data = AES.new(self.key, AES.MODE_CTR, nonce=nonce).encrypt(data)
+        return nonce + data + self.__tag(header, nonce, data)
+
+    def decrypt(self, data: bytes, header=b""):
+        if len(data) < self.NONCE_SIZE + self.TAG_SIZE:
+            raise ValueError("Encrypted body is too short")
+        nonce = data[:self.NONCE_SIZE]
+        tag = data[-self.TAG_SIZE:]
+        data = data[self.NONCE_SIZE:-self.TAG_SIZE]
+        if not hmac.compare_digest(tag, self.__tag(header, nonce, data)):
+            raise ValueError("Message authentication failed")
+        return AES.new(self.key, AES.MODE_CTR, nonce=nonce).decrypt(data)
 
 
 class AESCryptor:
@@ -20,6 +79,15 @@ class AESCryptor:
         self.key = hashlib.sha256(key.encode("utf-8")).digest()[:16]
         self.logger = logger
         self.mode = mode
+        self.max_frame_size = DEFAULT_MAX_FRAME_SIZE
+        # ciphers of protocol v2, frames are sent without encryption if there is no key
+        self.ciphers = {}
+        if not self.__no_encrypt:
+            self.ciphers = {
+                CIPHER_CBC: CBCCipher(self.key),
+                CIPHER_CTR_HMAC: CTRHMACCipher(key.encode("utf-8"))
+            }
+        self.frame_ciphers = {cipher.flag: cipher for cipher in self.ciphers.values()}
 
     def get_cryptor(self):
         return AES.new(self.key, self.mode, self.key)
@@ -39,7 +107,7 @@ class AESCryptor:
     def decrypt(self, text):
         if self.__no_encrypt:
             return text.decode("utf-8")
-        text = zlib.decompress(a2b_base64(text))
+        text = decompress(CODEC_ZLIB, a2b_base64(text), self.max_frame_size)
         try:
             result = unpad(self.get_cryptor().decrypt(text), 16)
         except Exception as err:
@@ -56,10 +124,3 @@ class AESCryptor:
             result = str(result, encoding="ISO-8859-1")
             self.logger.error("ISO-8859-1 = " + str(result))
         return result
-
-
-if __name__ == "__main__":
-    cryptor_test = AESCryptor("testing", CBRLogger("test"))
-    print(cryptor_test.encrypt("testing"))
-    # print(b2a_hex(bytes("test", "utf8")))
-    print(str(cryptor_test.key, "utf8").rstrip("\0"))
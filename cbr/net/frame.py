@@ -0,0 +1,301 @@
+"""
+    frame reader and frame format
+"""
+import json
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HEADER = struct.Struct("I")
+READ_SIZE = 65536
+# max size of a frame and a message after decompress
+DEFAULT_MAX_FRAME_SIZE = 4194304
+
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+# protocol v2 frame: magic, flags, action code, amount of fields, fields, body
+# each field is an unsigned short of length followed by utf-8 string, body is the rest of the frame
+# v1 frame is base64 or json text, which never starts with the magic byte
+MAGIC = 0xCB
+V2_HEADER = struct.Struct("BBBB")
+FIELD_HEADER = struct.Struct("H")
+FLAG_ENCRYPTED = 0x01
+# encrypted with authentication, the header is authenticated together with the body
+FLAG_AUTHENTICATED = 0x08
+CIPHER_MASK = FLAG_ENCRYPTED | FLAG_AUTHENTICATED
+# reply of command or api, so the frame can be routed without decrypting the body
+FLAG_REPLY = 0x10
+# bit 1-2 of flags is the codec of the body, the body is compressed before encrypt
+CODEC_SHIFT = 1
+CODEC_MASK = 0x03
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+CODECS = {"zlib": CODEC_ZLIB}
+if zstandard is not None:
+    CODECS["zstd"] = CODEC_ZSTD
+
+ACTION_JSON = 0
+ACTION_RESULT = 1
+ACTION_MESSAGE = 2
+ACTION_PING = 3
+ACTION_PONG = 4
+ACTION_STOP = 5
+ACTION_COMMAND = 6
+ACTION_API = 7
+ACTION_BATCH = 8
+ACTION_CODES = {
+    "result": ACTION_RESULT,
+    "message": ACTION_MESSAGE,
+    "stop": ACTION_STOP,
+    "command": ACTION_COMMAND,
+    "api": ACTION_API,
+    "batch": ACTION_BATCH
+}
+ROUTING_FIELDS = {
+    ACTION_COMMAND: ("sender", "receiver"),
+    ACTION_API: ("sender", "receiver")
+}
+ACTION_NAMES = {code: action for action, code in ACTION_CODES.items()}
+
+
+class FrameTooLargeError(ValueError):
+    pass
+
+
+class RoutedFrame:
+    """
+        A v2 command or api frame with its routing fields, the body is still encrypted
+    """
+    def __init__(self, frame: bytes, flags, action, sender, receiver):
+        self.frame = frame
+        self.flags = flags
+        self.action = action
+        self.sender = sender
+        self.receiver = receiver
+        self.responded = bool(flags & FLAG_REPLY)
+
+    def __repr__(self):
+        return f"RoutedFrame({self.action} from {self.sender} to {self.receiver}, responded={self.responded})"
+
+
+class FrameDecoder:
+    """
+        Buffer the byte stream of one connection and cut it into frames
+
+        A frame is a 4 byte unsigned int of length followed by the encrypted message,
+        tcp may split one frame into many reads or put many frames into one read
+    """
+    def __init__(self, max_size=DEFAULT_MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.max_size = max_size
+
+    def feed(self, data: bytes):
+        """
+            add data to the buffer and return every complete frame inside
+        """
+        self.buffer += data
+        frames = []
+        offset = 0
+        size = len(self.buffer)
+        while size - offset >= HEADER.size:
+            length = HEADER.unpack_from(self.buffer, offset)[0]
+            if length > self.max_size:
+                # checked before the body arrives, so the buffer never grows beyond max size
+                raise FrameTooLargeError(f"Frame size {length} is larger than {self.max_size}")
+            end = offset + HEADER.size + length
+            if end > size:
+                break
+            frames.append(bytes(self.buffer[offset + HEADER.size:end]))
+            offset = end
+        if offset:
+            del self.buffer[:offset]
+        return frames
+
+
+class FrameCompressor:
+    """
+        Compress the plaintext body of v2 frames with the codec and level negotiated at login
+
+        Body smaller than threshold is sent as it is, small chat messages are not worth the cpu
+    """
+    def __init__(self, codec="zlib", level=6, threshold=256):
+        self.codec = CODECS.get(codec, CODEC_NONE)
+        self.level = level
+        self.threshold = threshold
+
+    def compress(self, data: bytes):
+        """
+            return codec and data, codec is CODEC_NONE if data is not compressed
+        """
+        if self.codec == CODEC_NONE or len(data) < self.threshold:
+            return CODEC_NONE, data
+        if self.codec == CODEC_ZSTD:
+            result = zstandard.ZstdCompressor(level=self.level).compress(data)
+        else:
+            result = zlib.compress(data, self.level)
+        if len(result) >= len(data):
+            return CODEC_NONE, data
+        return self.codec, result
+
+
+def decompress(codec, data: bytes, max_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+        decompress at most max_size bytes, a small frame may expand to gigabytes
+    """
+    if codec == CODEC_NONE:
+        return data
+    elif codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise FrameTooLargeError(f"Message is larger than {max_size} after decompress")
+        if not decompressor.eof:
+            raise ValueError("Incomplete compressed data")
+        return result
+    elif codec == CODEC_ZSTD and zstandard is not None:
+        chunks = []
+        size = 0
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            while True:
+                chunk = reader.read(READ_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise FrameTooLargeError(f"Message is larger than {max_size} after decompress")
+                chunks.append(chunk)
+        return b"".join(chunks)
+    raise ValueError(f"Unsupported codec {codec}")
+
+
+def is_v2(frame: bytes):
+    return len(frame) >= V2_HEADER.size and frame[0] == MAGIC
+
+
+def pack_v2(code, fields: list, body: bytes, cipher=None, compressor: FrameCompressor = None, flags=0):
+    """
+        cipher is one of the ciphers in encrypt.py, the header is passed to it for authentication
+    """
+    if compressor is not None:
+        codec, body = compressor.compress(body)
+        flags |= codec << CODEC_SHIFT
+    if cipher is not None:
+        flags |= cipher.flag
+    data = bytearray(V2_HEADER.pack(MAGIC, flags, code, len(fields)))
+    for field in fields:
+        field = field.encode("utf-8")
+        data += FIELD_HEADER.pack(len(field)) + field
+    if cipher is not None:
+        body = cipher.encrypt(body, bytes(data))
+    data += body
+    return bytes(data)
+
+
+def read_v2(frame: bytes):
+    """
+        return flags, action code, fields and body of a v2 frame without decrypting the body
+    """
+    _, flags, code, count = V2_HEADER.unpack_from(frame)
+    offset = V2_HEADER.size
+    fields = []
+    for _ in range(count):
+        length = FIELD_HEADER.unpack_from(frame, offset)[0]
+        offset += FIELD_HEADER.size
+        fields.append(frame[offset:offset + length].decode("utf-8"))
+        offset += length
+    return flags, code, fields, frame[offset:]
+
+
+def peek_v2(frame: bytes):
+    """
+        return RoutedFrame if it is a command or api frame, else None
+    """
+    flags, code, fields, _ = read_v2(frame)
+    if code not in ROUTING_FIELDS.keys() or len(fields) != len(ROUTING_FIELDS[code]):
+        return None
+    return RoutedFrame(frame, flags, ACTION_NAMES[code], *fields)
+
+
+def encode_v2(msg: dict, cipher=None, compressor: FrameCompressor = None):
+    """
+        encode msg to a v2 frame, keepAlive has no body but is still encrypted so it can not be forged
+    """
+    action = msg.get("action")
+    if action == "keepAlive":
+        if msg.get("type") == "pong":
+            return pack_v2(ACTION_PONG, [], b"", cipher)
+        return pack_v2(ACTION_PING, [], b"", cipher)
+    code = ACTION_CODES.get(action, ACTION_JSON)
+    fields = [str(msg.get(i, "")) for i in ROUTING_FIELDS.get(code, ())]
+    flags = 0
+    if code in ROUTING_FIELDS.keys() and msg.get("result", {}).get("responded", False):
+        flags |= FLAG_REPLY
+    body = json.dumps(msg, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return pack_v2(code, fields, body, cipher, compressor, flags)
+
+
+def encode_v2_batch(frames: list, cipher=None, compressor: FrameCompressor = None):
+    """
+        frames are v2 frames, usually without encryption, the whole batch is compressed and encrypted once
+    """
+    body = b"".join(HEADER.pack(len(i)) + i for i in frames)
+    return pack_v2(ACTION_BATCH, [], body, cipher, compressor)
+
+
+def read_v2_body(frame: bytes, ciphers: dict = None, max_size=DEFAULT_MAX_FRAME_SIZE, inner=False):
+    """
+        return action code and the decrypted and decompressed body
+
+        ciphers is a dict of cipher flag and cipher, frame must be encrypted if there is any cipher,
+        inner frames of a batch are protected by the batch, so they can be not encrypted
+    """
+    flags, code, fields, body = read_v2(frame)
+    cipher_flag = flags & CIPHER_MASK
+    if cipher_flag:
+        if ciphers is None or cipher_flag not in ciphers.keys():
+            raise ValueError(f"Unsupported cipher flag {cipher_flag}")
+        body = ciphers[cipher_flag].decrypt(body, frame[:len(frame) - len(body)])
+    elif ciphers and not inner:
+        raise ValueError("Frame is not encrypted")
+    if code == ACTION_PING or code == ACTION_PONG:
+        return code, b""
+    body = decompress(flags >> CODEC_SHIFT & CODEC_MASK, body, max_size)
+    if len(body) > max_size:
+        raise FrameTooLargeError(f"Message is larger than {max_size} after decompress")
+    return code, body
+
+
+def decode_v2_body(code, body: bytes):
+    if code == ACTION_PING:
+        return {"action": "keepAlive", "type": "ping"}
+    elif code == ACTION_PONG:
+        return {"action": "keepAlive", "type": "pong"}
+    return json.loads(body)
+
+
+def decode_v2(frame: bytes, ciphers: dict = None, max_size=DEFAULT_MAX_FRAME_SIZE):
+    """
+        frames inside a batch share max_size with each other, so a batch can not expand to more than max_size
+    """
+    code, body = read_v2_body(frame, ciphers, max_size)
+    if code != ACTION_BATCH:
+        return decode_v2_body(code, body)
+    messages = []
+    remaining = max_size
+    for inner_frame in FrameDecoder(max_size).feed(body):
+        # relayed frames inside a batch are still encrypted, max_size 0 of zlib means no limit
+        inner_code, inner_body = read_v2_body(inner_frame, ciphers, max(remaining, 1), True)
+        if inner_code == ACTION_BATCH:
+            raise ValueError("Batch inside batch")
+        if len(inner_body) > remaining:
+            raise FrameTooLargeError(f"Batch is larger than {max_size} after decompress")
+        remaining -= len(inner_body)
+        messages.append(decode_v2_body(inner_code, inner_body))
+    return {"action": "batch", "messages": messages}
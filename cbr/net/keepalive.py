@@ -0,0 +1,86 @@
+"""
+    keepalive of all connections with one deadline heap
+"""
+import heapq
+import itertools
+import math
+import trio
+
+from typing import TYPE_CHECKING
+
+from cbr.lib.logger import CBRLogger
+
+if TYPE_CHECKING:
+    from cbr.net.network import Network
+    from cbr.net.process import ClientProcess
+
+
+class KeepAlive:
+    """
+        Track the last time every connection is seen, in one task with a heap of deadlines
+
+        Connection idle for idle seconds is pinged, and it is closed if still nothing after timeout seconds,
+        clients negotiated keepalive ping at half of idle, so the server only pings clients that miss it
+    """
+    def __init__(self, network: "Network", logger: CBRLogger):
+        self.network = network
+        self.logger = logger
+        self.idle = network.network_config["keepalive_idle"]
+        self.timeout = network.network_config["keepalive_timeout"]
+        self.connections = set()
+        self.heap = []
+        self.counter = itertools.count()
+        self.wakeup = trio.Event()
+        self.nursery = None
+
+    def register(self, connection: "ClientProcess"):
+        connection.last_seen = trio.current_time()
+        connection.pinged_at = None
+        self.connections.add(connection)
+        self.__schedule(connection, connection.last_seen + min(self.idle, self.timeout))
+        self.wakeup.set()
+
+    def unregister(self, connection: "ClientProcess"):
+        self.connections.discard(connection)
+
+    def __schedule(self, connection: "ClientProcess", deadline):
+        heapq.heappush(self.heap, (deadline, next(self.counter), connection))
+
+    async def run(self):
+        async with trio.open_nursery() as self.nursery:
+            while True:
+                now = trio.current_time()
+                while len(self.heap) != 0 and self.heap[0][0] <= now:
+                    connection = heapq.heappop(self.heap)[2]
+                    if connection in self.connections:
+                        self.check(connection, now)
+                deadline = self.heap[0][0] if len(self.heap) != 0 else math.inf
+                with trio.move_on_at(deadline):
+                    await self.wakeup.wait()
+                self.wakeup = trio.Event()
+
+    def check(self, connection: "ClientProcess", now):
+        idle = now - connection.last_seen
+        if idle >= self.timeout:
+            self.connections.discard(connection)
+            connection.timed_out = True
+            connection.cancel_scope.cancel()
+            return
+        if idle >= self.idle and connection.current_client != "":
+            if connection.pinged_at is None or connection.pinged_at < connection.last_seen:
+                connection.pinged_at = now
+                self.nursery.start_soon(self.ping, connection)
+            self.__schedule(connection, connection.last_seen + self.timeout)
+        elif idle >= self.idle:
+            # not login yet, nothing to ping
+            self.__schedule(connection, connection.last_seen + self.timeout)
+        else:
+            self.__schedule(connection, connection.last_seen + self.idle)
+
+    async def ping(self, connection: "ClientProcess"):
+        client = self.network.clients[connection.current_client]
+        self.logger.debug(f"{connection.current_client} is idle, ping now", "CBR")
+        try:
+            await self.network.write_ping(client)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            pass
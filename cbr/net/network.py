@@ -1,72 +1,364 @@
+import itertools
 import json
-import struct
 import trio
 
+from cbr.lib.client import Client, PendingResult
+from cbr.lib.config import DEFAULT_NETWORK_CONFIG
 from cbr.lib.logger import CBRLogger
-from cbr.net.encrypt import AESCryptor
+from cbr.net.encrypt import AESCryptor, CIPHER_CBC
+from cbr.net.frame import decode_v2, encode_v2, encode_v2_batch, is_v2, peek_v2, FrameCompressor, FrameDecoder, FrameTooLargeError, RoutedFrame, CIPHER_MASK, \
+    CODEC_MASK, CODEC_NONE, CODEC_SHIFT, CODECS, FLAG_ENCRYPTED, HEADER, PROTOCOL_V1, PROTOCOL_V2, READ_SIZE
+from cbr.net.outbound import OutboundMessage
 from cbr.resources import formatter
 
+SEND_OK = "sent"
+SEND_OFFLINE = "offline"
+SEND_CLOSED = "closed"
+SEND_TIMEOUT = "timeout"
+# put in the outbound queue of the client, its writer sends it later
+SEND_QUEUED = "queued"
+# chat message dropped as the outbound queue of the client is full
+SEND_DROPPED = "dropped"
+
 
 class NetworkBase(AESCryptor):
-    def __init__(self, logger: CBRLogger, key, clients):
+    def __init__(self, logger: CBRLogger, key, clients, network_config: dict = None):
         super().__init__(key, logger)
         self.logger = logger
         self.clients = clients
+        if network_config is None:
+            network_config = dict(DEFAULT_NETWORK_CONFIG)
+        self.network_config = network_config
+        self.max_frame_size = network_config["max_frame_size"]
+        self.compressors = {}
+        self.crypto_limiter = None
+        if network_config["crypto_threads"] > 0:
+            self.crypto_limiter = trio.CapacityLimiter(network_config["crypto_threads"])
+
+    async def receive_msg(self, stream: "trio.SocketStream", address, decoder: FrameDecoder, ciphers: dict = None):
+        frames = []
+        while not frames:
+            data = await stream.receive_some(READ_SIZE)
+            if not data:
+                raise trio.BrokenResourceError(f"Connection closed by {address}")
+            frames = decoder.feed(data)
+        msgs = []
+        for frame in frames:
+            msg = None
+            if is_v2(frame):
+                try:
+                    msg = peek_v2(frame)
+                except Exception:
+                    self.logger.bug(error=False)
+            if msg is None:
+                msg = await self.decode_msg(frame, ciphers)
+            self.logger.debug(f"Received {msg!r} from {address!r}", "CBR")
+            msgs.append(msg)
+        return msgs
 
-    async def receive_msg(self, stream: "trio.SocketStream", address):
-        data = await stream.receive_some(4)
-        if len(data) < 4:
-            self.logger.error(f"Data length error, Data = {data}")
-            return "{}"
-        length = struct.unpack("I", data)[0]
-        msg = await stream.receive_some(length)
+    async def decode_msg(self, frame: bytes, ciphers: dict = None):
+        """
+            return None if the frame can not be decoded
+        """
         try:
-            msg = self.decrypt(msg)
+            return await self.run_crypto(len(frame), self.decode_frame, frame, ciphers)
+        except FrameTooLargeError:
+            raise
         except Exception:
             self.logger.bug(error=False)
-            return "{}"
-        self.logger.debug(f"Received {msg!r} from {address!r}", "CBR")
-        return msg
+            return None
+
+    async def run_crypto(self, size, function, *args):
+        """
+            run encode or decode of a large frame in worker thread, so it does not stall other connections
+
+            aes, zlib and hash release the GIL, small frames are still faster inline
+        """
+        if self.crypto_limiter is None or size < self.network_config["crypto_thread_threshold"]:
+            return function(*args)
+        return await trio.to_thread.run_sync(function, *args, limiter=self.crypto_limiter)
+
+    def decode_frame(self, frame: bytes, ciphers: dict = None):
+        """
+            ciphers is the negotiated cipher of the connection after login, None to accept all of them before login
+        """
+        if is_v2(frame):
+            return decode_v2(frame, self.frame_ciphers if ciphers is None else ciphers, self.max_frame_size)
+        if ciphers is not None and len(self.ciphers) != 0 and FLAG_ENCRYPTED not in ciphers.keys():
+            # v1 is cbc, it is a downgrade if another cipher is negotiated
+            raise ValueError("Frame of protocol v1 is not accepted with the negotiated cipher")
+        return json.loads(self.decrypt(frame))
+
+    def pack_msg(self, message: OutboundMessage, encoding=(PROTOCOL_V1, "none", CIPHER_CBC)):
+        protocol, codec, cipher = encoding
+        if protocol == PROTOCOL_V2:
+            data = encode_v2(message.msg, self.ciphers.get(cipher), self.get_compressor(codec))
+        else:
+            data = self.encrypt(message.text())
+        return HEADER.pack(len(data)) + data
+
+    def pack_batch(self, messages: list, encoding=(PROTOCOL_V1, "none", CIPHER_CBC)):
+        protocol, codec, cipher = encoding
+        if protocol == PROTOCOL_V2:
+            data = encode_v2_batch([i.inner_frame() for i in messages], self.ciphers.get(cipher), self.get_compressor(codec))
+        else:
+            data = self.encrypt(formatter.batch_formatter([i.text() for i in messages]))
+        return HEADER.pack(len(data)) + data
 
-    async def send_msg(self, stream: "trio.SocketStream", msg, target=""):
+    def get_compressor(self, codec):
+        if codec not in self.compressors:
+            self.compressors[codec] = FrameCompressor(codec, self.network_config["compress_level"], self.network_config["compress_threshold"])
+        return self.compressors[codec]
+
+    def get_encoding(self, target):
+        """
+            protocol, codec and cipher of the target, messages are encoded once for each encoding
+        """
+        if target == "":
+            return PROTOCOL_V1, "none", CIPHER_CBC
+        capabilities = self.clients[target].capabilities
+        codec = capabilities.get("compression", {}).get("codec", "none")
+        return capabilities.get("protocol", PROTOCOL_V1), codec, capabilities.get("cipher", CIPHER_CBC)
+
+    def get_frame_ciphers(self, capabilities: dict):
+        """
+            cipher flag and cipher accepted from a client after login, only the negotiated one
+        """
+        cipher = self.ciphers.get(capabilities.get("cipher", CIPHER_CBC))
+        if cipher is None:
+            return {}
+        return {cipher.flag: cipher}
+
+    def can_relay(self, target, routed: RoutedFrame):
+        """
+            the frame can be sent to target as it is, if target can decode its codec and negotiated the same cipher
+        """
+        if target not in self.clients.keys() or not self.clients[target].online:
+            return False
+        protocol, codec, cipher = self.get_encoding(target)
+        if protocol != PROTOCOL_V2:
+            return False
+        frame_codec = routed.flags >> CODEC_SHIFT & CODEC_MASK
+        if frame_codec != CODEC_NONE and frame_codec != CODECS.get(codec):
+            return False
+        frame_cipher = routed.flags & CIPHER_MASK
+        if len(self.ciphers) == 0:
+            return frame_cipher == 0
+        return cipher in self.ciphers.keys() and self.ciphers[cipher].flag == frame_cipher
+
+    def get_capabilities(self, client_capabilities: dict):
+        """
+            capabilities that both server and client support, send back in login result
+        """
+        capabilities = {}
+        if client_capabilities.get("batch", False):
+            capabilities["batch"] = True
+        if client_capabilities.get("keepalive", False):
+            capabilities["keepalive"] = {
+                "interval": max(1, self.network_config["keepalive_idle"] // 2),
+                "timeout": self.network_config["keepalive_timeout"]
+            }
+        if self.network_config["protocol_v2"] and client_capabilities.get("protocol", PROTOCOL_V1) >= PROTOCOL_V2:
+            capabilities["protocol"] = PROTOCOL_V2
+            codec = self.network_config["compress_codec"]
+            if codec in CODECS and codec in client_capabilities.get("compression", []):
+                capabilities["compression"] = {
+                    "codec": codec,
+                    "level": self.network_config["compress_level"],
+                    "threshold": self.network_config["compress_threshold"]
+                }
+            cipher = self.network_config["cipher"]
+            if cipher != CIPHER_CBC and cipher in self.ciphers.keys() and cipher in client_capabilities.get("cipher", []):
+                capabilities["cipher"] = cipher
+        return capabilities
+
+    async def send_frame(self, stream: "trio.SocketStream", message: OutboundMessage, target="", droppable=False):
         if target == "":
             lock = trio.Lock()
         else:
+            queue = self.clients[target].queue
+            if queue is not None and queue.stream is stream:
+                await queue.put(message, droppable)
+                return
             lock = self.clients[target].send_lock
-            target = "to " + target
-        self.logger.debug(f"Send: {msg!r} {target}", "CBR")
-        msg = self.encrypt(msg)
-        msg = struct.pack("I", len(msg)) + msg
         async with lock:
-            await stream.send_all(msg)
+            await stream.send_all(await message.frame(self.get_encoding(target)))
+
+    async def send_msg(self, stream: "trio.SocketStream", msg, target="", droppable=False):
+        if target == "":
+            self.logger.debug(f"Send: {msg!r}", "CBR")
+        else:
+            self.logger.debug(f"Send: {msg!r} to {target}", "CBR")
+        await self.send_frame(stream, OutboundMessage(self, msg), target, droppable)
+
+    async def broadcast_msg(self, msg, targets: list, droppable=False):
+        """
+            encrypt msg once and send the same frame to all targets
+        """
+        if len(targets) == 0:
+            return {}
+        self.logger.debug(f"Broadcast: {msg!r} to {', '.join(targets)}", "CBR")
+        message = OutboundMessage(self, msg)
+        return await self.fan_out(dict.fromkeys(targets, message), droppable)
+
+    async def fan_out(self, messages: dict, droppable=False, timeout=None):
+        """
+            send messages to their target at the same time
+
+            messages is a dict of target and OutboundMessage, return a dict of target and delivery status
+        """
+        if timeout is None:
+            timeout = self.network_config["send_timeout"]
+        results = {}
+        async with trio.open_nursery() as nursery:
+            for target, message in messages.items():
+                nursery.start_soon(self.__send_before_deadline, target, message, droppable, timeout, results)
+        return results
+
+    async def __send_before_deadline(self, target, message: OutboundMessage, droppable, timeout, results: dict):
+        client = self.clients[target]
+        if not client.online:
+            results[target] = SEND_OFFLINE
+            return
+        stream = client.stream
+        queue = client.queue
+        if queue is not None and queue.stream is stream:
+            # putting never waits, a slow client is disconnected by the queue instead of timeout here
+            results[target] = SEND_QUEUED if await queue.put(message, droppable) else SEND_DROPPED
+            return
+        results[target] = SEND_TIMEOUT
+        with trio.move_on_after(timeout):
+            try:
+                await self.send_frame(stream, message, target, droppable)
+                results[target] = SEND_OK
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                results[target] = SEND_CLOSED
+                self.logger.debug(f"Send to {target} failed, connection closed", "CBR")
+        if results[target] == SEND_TIMEOUT:
+            # a cancelled send_all leaves part of the frame in the stream, the connection is useless now
+            self.logger.warning(f"Send to {target} time out after {timeout}s, disconnect now")
+            client.online = False
+            await trio.aclose_forcefully(stream)
 
 
 class Network(NetworkBase):
-    def __init__(self, logger: CBRLogger, key, clients):
-        super().__init__(logger, key, clients)
+    def __init__(self, logger: CBRLogger, key, clients, network_config: dict = None):
+        super().__init__(logger, key, clients, network_config)
         self.formatter = formatter
+        self.request_ids = itertools.count(1)
+        self.query_cache = {}
+        self.query_flights = {}
 
     async def send_ping(self, stream: "trio.SocketStream", pong=False, target=""):
         msg = self.formatter.ping_formatter(pong)
         await self.send_msg(stream, msg, target)
 
-    async def send_login_result(self, stream: "trio.SocketStream", success=True, target=""):
-        msg = self.formatter.login_formatter(success)
+    async def write_ping(self, client: "Client", pong_event: trio.Event = None):
+        """
+            write ping to the stream directly instead of the queue, so its time does not include waiting in the queue
+
+            return the time it is written, or None if the client is disconnected as it is too slow
+        """
+        frame = await OutboundMessage(self, self.formatter.ping_formatter(False)).frame(self.get_encoding(client.name))
+        stream = client.stream
+        with trio.move_on_after(self.network_config["send_timeout"]):
+            async with client.send_lock:
+                client.pings_sent += 1
+                if pong_event is not None:
+                    client.probe = (client.pings_sent, pong_event)
+                write_time = trio.current_time()
+                await stream.send_all(frame)
+                return write_time
+        self.logger.warning(f"Send ping to {client.name} time out after {self.network_config['send_timeout']}s, disconnect now")
+        client.online = False
+        await trio.aclose_forcefully(stream)
+        return None
+
+    async def send_login_result(self, stream: "trio.SocketStream", success=True, target="", capabilities: dict = None):
+        msg = self.formatter.login_formatter(success, capabilities)
         await self.send_msg(stream, msg, target)
 
     async def send_command(self, stream: "trio.SocketStream", cmd, target_client):
-        msg = self.formatter.command_formatter(cmd, target_client)
+        # with an id nobody waits for, so the result does not go to other queries
+        msg = self.formatter.command_formatter(cmd, target_client, next(self.request_ids))
         await self.send_msg(stream, msg, target_client)
 
     async def send_message(self, stream: "trio.SocketStream", client, player, message, receiver="", target=""):
         msg = self.formatter.message_formatter(client, player, message, receiver)
-        await self.send_msg(stream, msg, target)
+        await self.send_msg(stream, msg, target, droppable=True)
+
+    async def send_messages(self, messages: dict, client, player, receiver=""):
+        """
+            send messages to many targets at the same time, messages is a dict of target and message
+
+            same message is only encrypted once, return a dict of target and delivery status
+        """
+        outbound_messages = {}
+        cache = {}
+        for target, message in messages.items():
+            if message not in cache:
+                msg = self.formatter.message_formatter(client, player, message, receiver)
+                self.logger.debug(f"Send: {msg!r}", "CBR")
+                cache[message] = OutboundMessage(self, msg)
+            outbound_messages[target] = cache[message]
+        return await self.fan_out(outbound_messages, droppable=True)
 
     async def send_api(self, stream: "trio.SocketStream", receiver, plugin_id, function_name, keys: dict, target=""):
-        msg = self.formatter.api_formatter(receiver, plugin_id, function_name, keys)
+        msg = self.formatter.api_formatter(receiver, plugin_id, function_name, keys, next(self.request_ids))
         await self.send_msg(stream, msg, target)
 
     async def send_stop(self, stream: "trio.SocketStream", target=""):
-        message = {"action": "stop"}
-        msg = json.dumps(message)
+        msg = self.formatter.stop_formatter()
         await self.send_msg(stream, msg, target)
+
+    async def command_query(self, target, cmd, timeout=2):
+        msg = self.formatter.command_formatter(cmd, target, next(self.request_ids))
+        return await self.__query(target, msg, timeout)
+
+    async def cached_command_query(self, target, cmd, cache_ttl=0, timeout=2):
+        """
+            same query to the same target in flight is only sent once, the others wait for its result
+
+            result is kept for cache_ttl seconds, failed query is not cached
+        """
+        key = (target, cmd)
+        now = trio.current_time()
+        if key in self.query_cache.keys() and self.query_cache[key][0] > now:
+            return self.query_cache[key][1]
+        if key in self.query_flights.keys():
+            flight = self.query_flights[key]
+            await flight.event.wait()
+            return flight.result
+        flight = PendingResult()
+        self.query_flights[key] = flight
+        try:
+            flight.result = await self.command_query(target, cmd, timeout)
+        finally:
+            del self.query_flights[key]
+            flight.set(flight.result)
+        if flight.result is not None and cache_ttl > 0:
+            for i in [i for i, cache in self.query_cache.items() if cache[0] <= now]:
+                del self.query_cache[i]
+            self.query_cache[key] = (now + cache_ttl, flight.result)
+        return flight.result
+
+    async def api_query(self, target, plugin_id, function_name, keys: list, timeout=2):
+        msg = self.formatter.api_formatter(target, plugin_id, function_name, keys, next(self.request_ids))
+        return await self.__query(target, msg, timeout)
+
+    async def __query(self, target, msg, timeout):
+        """
+            send query with a request id and wait for its own reply, queries to one client do not block each other
+
+            return None if timeout or error
+        """
+        client = self.clients[target]
+        pending = PendingResult()
+        client.pending[msg["id"]] = pending
+        try:
+            with trio.move_on_after(timeout):
+                await self.send_msg(client.stream, msg, target)
+                await pending.event.wait()
+        finally:
+            client.pending.pop(msg["id"], None)
+        return pending.result
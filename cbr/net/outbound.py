@@ -0,0 +1,251 @@
+"""
+    outbound queue of clients
+"""
+import json
+import trio
+
+from collections import deque
+from typing import TYPE_CHECKING
+
+from cbr.lib.logger import CBRLogger
+from cbr.net.frame import encode_v2, RoutedFrame, HEADER
+
+if TYPE_CHECKING:
+    from cbr.lib.client import Client
+    from cbr.net.network import NetworkBase
+
+POLICY_DROP = "drop"
+POLICY_DISCONNECT = "disconnect"
+
+
+class OutboundMessage:
+    """
+        A message waiting to be sent, it is encrypted at most once for each encoding however many clients it goes to
+    """
+    def __init__(self, network: "NetworkBase", msg: dict):
+        self.network = network
+        self.msg = msg
+        self.__text = None
+        self.__frames = {}
+        self.__packing = {}
+
+    def text(self):
+        if self.__text is None:
+            self.__text = json.dumps(self.msg)
+        return self.__text
+
+    def size(self):
+        return len(self.text())
+
+    def inner_frame(self):
+        """
+            v2 frame inside a batch, not encrypted since the batch is encrypted
+        """
+        return encode_v2(self.msg)
+
+    async def frame(self, encoding):
+        """
+            targets with the same encoding wait for the first one instead of encrypting again
+        """
+        while encoding not in self.__frames:
+            if encoding in self.__packing:
+                await self.__packing[encoding].wait()
+                continue
+            self.__packing[encoding] = trio.Event()
+            try:
+                self.__frames[encoding] = await self.network.run_crypto(self.size(), self.network.pack_msg, self, encoding)
+            finally:
+                self.__packing.pop(encoding).set()
+        return self.__frames[encoding]
+
+
+class RelayMessage(OutboundMessage):
+    """
+        A v2 frame from another client, sent as it is without decrypting
+    """
+    def __init__(self, network: "NetworkBase", routed: RoutedFrame):
+        super().__init__(network, {"action": routed.action, "sender": routed.sender, "receiver": routed.receiver})
+        self.routed = routed
+
+    def size(self):
+        return len(self.routed.frame)
+
+    def inner_frame(self):
+        return self.routed.frame
+
+    async def frame(self, encoding):
+        return HEADER.pack(len(self.routed.frame)) + self.routed.frame
+
+
+class OutboundQueue:
+    """
+        Messages waiting to be sent to one client, drained by its own writer task
+
+        A slow client only fills its own queue and never blocks the sender
+    """
+    def __init__(self, network: "NetworkBase", client: "Client", stream: trio.SocketStream, logger: CBRLogger):
+        network_config = network.network_config
+        self.network = network
+        self.client = client
+        self.stream = stream
+        self.logger = logger
+        self.size = network_config["send_queue_size"]
+        self.policy = network_config["slow_client_policy"]
+        self.timeout = network_config["slow_client_timeout"]
+        self.batch_window = 0
+        if client.capabilities.get("batch", False):
+            self.batch_window = network_config["batch_window"] / 1000
+        self.batch_bytes = network_config["batch_bytes"]
+        self.encoding = network.get_encoding(client.name)
+        self.send_channel, self.receive_channel = trio.open_memory_channel(self.size)
+        # messages taken out of the channel while looking for a chat message to drop, they count in the size
+        self.held = deque()
+        # messages that can not be dropped when the queue is full, sent after the channel in the order they come
+        self.overflow = deque()
+        self.cancel_scope = trio.CancelScope()
+        self.finished = trio.Event()
+        self.closed = False
+        self.full_since = None
+        self.full = trio.Event()
+        self.dropped = 0
+
+    def depth(self):
+        return self.send_channel.statistics().current_buffer_used + len(self.held) + len(self.overflow)
+
+    async def put(self, message: OutboundMessage, droppable=False):
+        """
+            queue message without waiting, droppable messages are chat messages
+
+            if the queue is full, chat messages are dropped and other messages wait in overflow instead of being lost,
+            the client is disconnected by __watch_full if it is still full after timeout seconds
+
+            return False if the message is dropped
+        """
+        if self.closed:
+            return False
+        if len(self.overflow) == 0 and (self.depth() < self.size or self.__make_room()):
+            try:
+                self.send_channel.send_nowait((message, droppable))
+            except (trio.ClosedResourceError, trio.BrokenResourceError):
+                return False
+            return True
+        if droppable:
+            self.dropped += 1
+            return False
+        self.overflow.append(message)
+        self.__mark_full()
+        return True
+
+    def __mark_full(self):
+        if self.full_since is None:
+            self.full_since = trio.current_time()
+            self.full.set()
+
+    def __make_room(self):
+        if self.policy == POLICY_DISCONNECT:
+            self.__mark_full()
+            return False
+        return self.__drop_oldest_chat()
+
+    def __drop_oldest_chat(self):
+        while True:
+            try:
+                item = self.receive_channel.receive_nowait()
+            except trio.WouldBlock:
+                return False
+            if item[1]:
+                self.dropped += 1
+                return True
+            self.held.append(item)
+
+    async def __watch_full(self):
+        """
+            disconnect the client if the queue stays full for timeout seconds, even if nothing more is sent to it
+        """
+        while True:
+            await self.full.wait()
+            self.full = trio.Event()
+            full_since = self.full_since
+            if full_since is None:
+                continue
+            await trio.sleep_until(full_since + self.timeout)
+            if self.full_since == full_since:
+                await self.disconnect(f"queue is full for {self.timeout}s")
+                return
+
+    async def disconnect(self, reason):
+        self.logger.warning(f"Client {self.client.name} is too slow, {reason}, disconnect now")
+        self.client.online = False
+        await trio.aclose_forcefully(self.stream)
+        self.abort()
+
+    async def __next_message(self):
+        if self.held:
+            return self.held.popleft()[0]
+        if self.overflow:
+            try:
+                return self.receive_channel.receive_nowait()[0]
+            except (trio.WouldBlock, trio.EndOfChannel):
+                return self.overflow.popleft()
+        try:
+            return (await self.receive_channel.receive())[0]
+        except trio.EndOfChannel:
+            return None
+
+    async def __collect_batch(self, messages: list):
+        size = messages[0].size()
+        with trio.move_on_after(self.batch_window):
+            while size < self.batch_bytes:
+                message = await self.__next_message()
+                if message is None:
+                    return
+                messages.append(message)
+                size += message.size()
+
+    async def run(self):
+        with self.cancel_scope:
+            async with trio.open_nursery() as nursery:
+                nursery.start_soon(self.__watch_full)
+                await self.__write()
+                nursery.cancel_scope.cancel()
+        self.send_channel.close()
+        self.finished.set()
+
+    async def __write(self):
+        while True:
+            message = await self.__next_message()
+            if message is None:
+                break
+            messages = [message]
+            if self.batch_window > 0:
+                await self.__collect_batch(messages)
+            if len(messages) == 1:
+                frame = await message.frame(self.encoding)
+            else:
+                size = sum(i.size() for i in messages)
+                frame = await self.network.run_crypto(size, self.network.pack_batch, messages, self.encoding)
+            try:
+                async with self.client.send_lock:
+                    await self.stream.send_all(frame)
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                self.logger.debug(f"Writer of {self.client.name} stopped, connection closed", "CBR")
+                break
+            # the client is reading again, wait timeout seconds more for the rest of overflow
+            self.full_since = None
+            if self.overflow:
+                self.__mark_full()
+
+    async def close(self, wait_time=1):
+        """
+            stop accepting frames and wait for the writer to send the rest
+        """
+        self.closed = True
+        self.send_channel.close()
+        with trio.move_on_after(wait_time):
+            await self.finished.wait()
+        self.cancel_scope.cancel()
+
+    def abort(self):
+        self.closed = True
+        self.send_channel.close()
+        self.cancel_scope.cancel()
@@ -0,0 +1,114 @@
+"""
+    online players of mc clients, kept from joined and left messages
+"""
+import trio
+
+from typing import TYPE_CHECKING
+
+from cbr.lib.logger import CBRLogger
+
+if TYPE_CHECKING:
+    from cbr.net.network import Network
+
+
+class PresenceIndex:
+    """
+        Player to client and client to players, player name is case-insensitive
+
+        Sets are replaced instead of modified, so plugin threads can read them without lock
+    """
+    def __init__(self):
+        self.players = {}
+        self.clients = {}
+        # count of joined and left messages of each client
+        self.version = {}
+
+    def join(self, client, player):
+        self.version[client] = self.version.get(client, 0) + 1
+        old = self.players.get(player.lower())
+        if old is not None and old[0] != client:
+            # joined another server before the left message of the old one
+            self.__discard(old[0], old[1])
+        self.players[player.lower()] = (client, player)
+        self.clients[client] = self.clients.get(client, frozenset()) | {player}
+
+    def leave(self, client, player):
+        self.version[client] = self.version.get(client, 0) + 1
+        old = self.players.get(player.lower())
+        if old is not None and old[0] == client:
+            del self.players[player.lower()]
+        self.__discard(client, player)
+
+    def clear(self, client):
+        for player in self.clients.pop(client, frozenset()):
+            self.leave(client, player)
+
+    def replace(self, client, players: list):
+        """
+            repair the index of client with the full player list
+        """
+        for player in self.get_players(client):
+            if player not in players:
+                self.leave(client, player)
+        for player in players:
+            self.join(client, player)
+
+    def get_players(self, client):
+        return self.clients.get(client, frozenset())
+
+    def find_player(self, player):
+        old = self.players.get(player.lower())
+        if old is None:
+            return None
+        return old[0]
+
+    def __discard(self, client, player):
+        players = self.clients.get(client, frozenset()) - {player}
+        if len(players) == 0:
+            self.clients.pop(client, None)
+        else:
+            self.clients[client] = players
+
+
+def parse_list(result):
+    """
+        player list from result of vanilla `list`: There are 1 of a max of 20 players online: player
+
+        return None if it is not the result of `list`
+    """
+    if result is None or "online:" not in result:
+        return None
+    players = result.split("online:", 1)[1].split(",")
+    return [i.strip() for i in players if i.strip() != ""]
+
+
+class PresenceMonitor:
+    """
+        Query `list` of mc clients every interval seconds and after login, to repair the missed joined or left messages
+    """
+    def __init__(self, network: "Network", logger: CBRLogger):
+        self.network = network
+        self.logger = logger
+        self.interval = network.network_config["presence_interval"]
+
+    async def run(self):
+        if self.interval <= 0:
+            return
+        while True:
+            await trio.sleep(self.interval)
+            async with trio.open_nursery() as nursery:
+                for client in self.network.clients.values():
+                    if client.online and client.type == "mc":
+                        nursery.start_soon(self.reconcile, client.name)
+
+    async def reconcile(self, client):
+        version = self.network.presence.version.get(client, 0)
+        players = parse_list(await self.network.cached_command_query(client, "list", 1))
+        if players is None or not self.network.clients[client].online:
+            self.logger.debug(f"Fail to get player list of {client}", "CBR")
+            return
+        if self.network.presence.version.get(client, 0) != version:
+            # the list may be older than the joined or left message, try again next time
+            return
+        self.network.presence.replace(client, players)
+        self.logger.debug(f"Players in {client}: {players}", "CBR")
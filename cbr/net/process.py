@@ -1,10 +1,12 @@
 import json
-import time
 import trio
 
 from typing import TYPE_CHECKING
 
 from cbr.lib.logger import CBRLogger
+from cbr.net.frame import FrameDecoder, RoutedFrame, CIPHER_MASK
+from cbr.net.outbound import OutboundQueue, RelayMessage
+from cbr.net.rtt import RTTStats
 from cbr.plugin.info import MessageInfo
 from cbr.resources import formatter
 
@@ -12,6 +14,8 @@ if TYPE_CHECKING:
     from cbr.net.tcpserver import CBRTCPServer
     from cbr.plugin.plugin import PluginManager
 
+PLUGIN_STATS_PATH = "logs/plugin_stats.json"
+
 help_msg = """§r====================CBR====================
 ##help §r->§a get plugin help msg
 ##CBR help/? §r->§a get help msg
@@ -39,6 +43,8 @@ status_msg = """§r====================CBR====================
 ##CBR status CBR §r->§a show CBR status
 ##CBR status ping §e[client_name] §r->§a show ping of clients
 ##CBR status online §r->§a show status of clients
+##CBR status plugin §e[plugin_id] §r->§a show latency of plugin events
+##CBR status plugin dump §r->§a save latency of plugin events to logs/plugin_stats.json
 ##CBR status all §r->§a Reload all above
 """
 cli_help_msg = """§r====================CBR====================
@@ -67,7 +73,11 @@ class Process:
     async def close_connection(self, stream: trio.SocketStream, target):
         if target != "" and self.server.clients[target].online:
             self.server.clients[target].online = False
+            self.server.clients[target].cancel_pending()
             await self.server.send_stop(stream, target)
+            queue = self.server.clients[target].queue
+            if queue is not None and queue.stream is stream:
+                await queue.close()
             process = self.server.clients[target].process
             process.cancelled = True
             if process.cancel_scope is not None:
@@ -78,36 +88,29 @@ class Process:
             await stream.aclose()
 
     async def msg_mc_server(self, msg, client_except=""):
+        targets = []
         for i in self.server.clients.keys():
             if client_except != i and self.server.clients[i].online and (self.server.clients[i].type == "mc" or client_except == "CBR"):
-                stream = self.server.clients[i].stream
-                await self.server.send_msg(stream, str(msg), i)
+                targets.append(i)
+        await self.server.broadcast_msg(msg, targets, droppable=True)
 
-    async def ping_test(self, target):
+    def ping_log(self, target):
         client = self.server.clients[target]
+        rtt = client.rtt
         if not client.online:
-            return -2
-        self.logger.debug(f"Ping to {target}", "CBR")
-        client.process.ping_end = -1
-        with trio.move_on_after(2) as client.ping_lock:
-            start_time = time.time()
-            await self.server.send_ping(client.stream, target=target)
-            await trio.sleep(2)
-        if client.process.ping_end == -1:
-            self.logger.debug(f"No response from {target}", "CBR")
-            return -1
-        ping = (client.process.ping_end - start_time) * 1000
-        self.logger.debug(f"get ping result from {target}:{ping}", "CBR")
-        return round(ping, 1)
-
-    @staticmethod
-    def ping_log(ping, target):
-        if ping == -2:
             return f"- {target}: Offline"
-        elif ping == -1:
-            return f"- {target}: No response - time = 2000ms"
-        else:
-            return f"- {target}: Alive - time = {ping}ms"
+        elif rtt.samples == 0 and rtt.lost == 0:
+            return f"- {target}: Alive - no ping result yet"
+        elif rtt.last is None:
+            return f"- {target}: No response - time > {self.server.network_config['rtt_timeout'] * 1000}ms, lost = {rtt.lost}"
+        return f"- {target}: Alive - time = {rtt.last}ms, avg = {round(rtt.ewma, 1)}ms, min = {rtt.min}ms, max = {rtt.max}ms, lost = {rtt.lost}"
+
+    def ping_detail(self, target):
+        msg = self.ping_log(target)
+        rtt = self.server.clients[target].rtt
+        if rtt.samples != 0:
+            msg += f"\n  {rtt.histogram_text()}"
+        return msg
 
     async def message_process(self, client, player, msg, current_client, event="on_message", raw_msg: dict = None):
         message = self.formatter.info_formatter(client, player, msg)
@@ -116,23 +119,25 @@ class Process:
         else:
             client_type = ""
         info = MessageInfo(client, msg, player, client_type, self.logger)
-        async with trio.open_nursery() as nursery:
-            await self.plugin_manager.run_event(event, info, nursery=nursery)
-            if event == "on_message":
-                if info.is_send_message():
-                    await self.msg_mc_server(self.formatter.message_formatter(client, player, msg), current_client)
-                    self.logger.chat(message)
-                args = msg.split(" ")
-                if player == "" and len(args) == 3 and info.client_type == "mc":
-                    if args[1] == "joined":
-                        await self.plugin_manager.run_event("on_player_joined", args[0], info, nursery=nursery)
-                    elif args[1] == "left":
-                        await self.plugin_manager.run_event("on_player_left", args[0], info, nursery=nursery)
+        # events run in the nursery of server, message is forwarded without waiting for runaway events
+        await self.plugin_manager.run_event(event, info)
+        if event == "on_message":
+            if info.is_send_message():
+                await self.msg_mc_server(self.formatter.message_formatter(client, player, msg), current_client)
+                self.logger.chat(message)
+            args = msg.split(" ")
+            if player == "" and len(args) == 3 and info.client_type == "mc":
+                if args[1] == "joined":
+                    self.server.presence.join(client, args[0])
+                    await self.plugin_manager.run_event("on_player_joined", args[0], info)
+                elif args[1] == "left":
+                    self.server.presence.leave(client, args[0])
+                    await self.plugin_manager.run_event("on_player_left", args[0], info)
+        else:
+            if info.is_send_message():
+                return False
             else:
-                if info.is_send_message():
-                    return False
-                else:
-                    return True
+                return True
 
 
 class ServerProcess(Process):
@@ -146,12 +151,12 @@ class ServerProcess(Process):
         cnt = len(self.server.clients)
         msg = f"Client count: {cnt}"
         for i in self.server.clients.keys():
-            msg += f"\n- {i} : online = {self.server.clients[i].online}"
+            client = self.server.clients[i]
+            msg += f"\n- {i} : online = {client.online}"
+            if client.online and client.queue is not None:
+                msg += f", queue = {client.queue.depth()}/{client.queue.size}, dropped = {client.queue.dropped}"
         return msg
 
-    async def ping_cache(self, target):
-        self.server.clients[target].ping = await self.ping_test(target)
-
     def count_online_client(self):
         count = 0
         for i in self.server.clients.values():
@@ -165,14 +170,41 @@ class ServerProcess(Process):
         msg += f"Online Client : {self.count_online_client()}"
         return msg
 
-    async def ping_all(self):
-        self.logger.debug("Start ping", "CBR")
-        async with trio.open_nursery() as nursery:
-            for i in self.server.clients.keys():
-                nursery.start_soon(self.ping_cache, i)
+    def plugin_status(self, plugin_id=None):
+        plugins = self.plugin_manager.plugins
+        if plugin_id is None:
+            msg = "Plugin events:"
+            for i in plugins.values():
+                msg += f"\n- {i.id}: {i.stats.summary_text()}"
+            return msg
+        if plugin_id not in plugins.keys():
+            return f"Plugin {plugin_id} not exist"
+        return f"Plugin {plugin_id}: {plugins[plugin_id].worker.status()}\n{plugins[plugin_id].stats.text()}"
+
+    async def dump_plugin_stats(self):
+        """
+            write the file in a thread, a slow disk does not block the trio loop
+        """
+        data = json.dumps(self.plugin_manager.get_plugin_stats(), indent=2)
+        try:
+            await trio.to_thread.run_sync(self.__write_file, PLUGIN_STATS_PATH, data)
+        except OSError as e:
+            self.logger.error(f"Fail to save plugin statistics to {PLUGIN_STATS_PATH}: {e}")
+            return f"Fail to save plugin statistics to {PLUGIN_STATS_PATH}: {e}"
+        return f"Plugin statistics saved to {PLUGIN_STATS_PATH}"
+
+    @staticmethod
+    def __write_file(path, data):
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(data)
+
+    def ping_all(self):
+        """
+            ping result measured in background by RTTMonitor
+        """
         msg = ""
         for i in self.server.clients.keys():
-            msg += "\n" + self.ping_log(self.server.clients[i].ping, i)
+            msg += "\n" + self.ping_log(i)
         return msg
 
     @staticmethod
@@ -201,16 +233,45 @@ class ClientProcess(Process):
         self.server = tcp_server
         self.logger = logger
         self.current_client = ""
-        self.ping_end = 0
         self.cancelled = False
+        # managed by KeepAlive, the scope is cancelled if nothing received for keepalive_timeout
+        self.cancel_scope = trio.CancelScope()
+        self.timed_out = False
+        self.last_seen = 0
+        self.pinged_at = None
+        self.decoder = FrameDecoder(tcp_server.max_frame_size)
+        # None before login, then only the negotiated cipher is accepted, so frames can not be downgraded
+        self.frame_ciphers = None
+
+    async def relay_frame(self, routed: RoutedFrame):
+        """
+            forward command or api frame between clients without decrypting it
 
-    async def add_new_client(self, stream: trio.SocketStream, name, lib_version, client_type):
+            return False if it has to be decoded, the frame to CBR or to clients not supporting it
+        """
+        if self.current_client == "":
+            return False
+        if self.frame_ciphers and routed.flags & CIPHER_MASK not in self.frame_ciphers.keys():
+            # decode it, so the frame with other cipher is rejected
+            return False
+        target = routed.sender if routed.responded else routed.receiver
+        if target == "CBR" or not self.server.can_relay(target, routed):
+            return False
+        await self.server.send_frame(self.server.clients[target].stream, RelayMessage(self.server, routed), target)
+        self.logger.debug(f"Relay {routed.action} from {self.current_client} to {target}", "CBR")
+        return True
+
+    async def add_new_client(self, stream: trio.SocketStream, name, lib_version, client_type, capabilities, nursery: trio.Nursery):
         reconnect = False
         if self.server.clients[name].online:
             self.logger.debug(f"{name} already exist, stop old connection now", "CBR")
             await self.close_connection(self.server.clients[name].stream, name)
             reconnect = True
         self.server.clients[name].stream = stream
+        self.server.clients[name].capabilities = capabilities
+        self.server.clients[name].rtt = RTTStats()
+        self.server.clients[name].reset_ping()
+        self.open_queue(stream, name, nursery)
         self.server.clients[name].online = True
         self.server.clients[name].type = client_type
         if lib_version is not None:
@@ -223,6 +284,19 @@ class ClientProcess(Process):
         else:
             self.logger.info(f"Client: '{self.current_client}' connected to the server{lib_msg}")
 
+    def open_queue(self, stream: trio.SocketStream, name, nursery: trio.Nursery):
+        client = self.server.clients[name]
+        if self.config.network["send_queue_size"] <= 0:
+            client.queue = None
+            return
+        client.queue = OutboundQueue(self.server, client, stream, self.logger)
+        nursery.start_soon(client.queue.run)
+
+    def capabilities_check(self, msg):
+        if "capabilities" not in msg.keys() or type(msg["capabilities"]) != dict:
+            return {}
+        return self.server.get_capabilities(msg["capabilities"])
+
     @staticmethod
     def client_type_check(msg):  # For old ChatBridge
         if "type" not in msg.keys():
@@ -258,11 +332,15 @@ class ClientProcess(Process):
             if msg["action"] == "login":
                 lib_version = self.version_check(msg)
                 client_type = self.client_type_check(msg)
+                capabilities = self.capabilities_check(msg)
                 if self.login(msg["name"], msg["password"], self.server.config.clients):
                     self.current_client = msg["name"]
-                    await self.add_new_client(stream, msg["name"], lib_version, client_type)
-                    await self.server.send_login_result(stream, target=self.current_client)
+                    await self.add_new_client(stream, msg["name"], lib_version, client_type, capabilities, nursery)
+                    self.frame_ciphers = self.server.get_frame_ciphers(capabilities)
+                    await self.server.send_login_result(stream, target=self.current_client, capabilities=capabilities)
                     self.server.register_process(self, self.current_client)
+                    if client_type == "mc":
+                        nursery.start_soon(self.server.presence_monitor.reconcile, self.current_client)
                 else:
                     await self.server.send_login_result(stream, False)
                     await stream.aclose()
@@ -271,11 +349,15 @@ class ClientProcess(Process):
                 if msg["type"] == "ping":
                     await self.server.send_ping(stream, True, self.current_client)
                 elif msg["type"] == "pong":
-                    self.ping_end = time.time()
-                    self.server.clients[self.current_client].ping_lock.cancel()
+                    self.server.clients[self.current_client].on_pong()
             elif msg["action"] == "message":
                 nursery.start_soon(self.message_process, msg["client"], msg["player"], msg["message"],
                                    self.current_client, "on_message", msg)
+            elif msg["action"] == "batch":
+                for i in msg["messages"]:
+                    await self.process_msg(i, stream, address, nursery)
+                    if self.cancelled:
+                        return
             elif msg["action"] == "stop":
                 await self.close_connection(stream, self.current_client)
                 self.logger.info(f"Connection closed from {self.current_client}")
@@ -285,29 +367,28 @@ class ClientProcess(Process):
                 command = msg["command"]
                 if msg["result"]["responded"]:
                     if sender == "CBR":
+                        result = None
                         if "type" not in msg["result"].keys():
                             self.logger.warning(
                                 f"Unknown result of sending {command} to {receiver} , maybe you should update the version of CBR client")
-                            self.server.clients[self.current_client].cmd_result = None
                         elif msg["result"]["type"] == 0:
-                            self.server.clients[self.current_client].cmd_result = msg["result"]["result"]
+                            result = msg["result"]["result"]
                             self.logger.debug(
                                 f"Result of Command to {receiver} finished, result: {msg['result']['result']}", "CBR")
                         elif msg["result"]["type"] == 1:
-                            self.server.clients[self.current_client].cmd_result = None
                             self.logger.warning(f"Command to {receiver} failed")
                         elif msg["result"]["type"] == 2:
-                            self.server.clients[self.current_client].cmd_result = None
                             self.logger.warning(f"Client {receiver} does not connected to rcon")
-                        self.server.clients[self.current_client].cmd_lock.cancel()
+                        if not self.server.clients[self.current_client].resolve(msg.get("id"), result):
+                            self.logger.debug(f"No query waiting for result of Command to {receiver}", "CBR")
                     elif self.server.clients[sender].online:
-                        await self.server.send_msg(self.server.clients[sender].stream, json.dumps(msg), sender)
+                        await self.server.send_msg(self.server.clients[sender].stream, msg, sender)
                         self.logger.info(f"Result of {command} send to {sender}")
                     else:
                         self.logger.error(f"Client {sender} is Closed")
                 else:
                     if self.server.clients[receiver].online:
-                        await self.server.send_msg(self.server.clients[receiver].stream, json.dumps(msg), receiver)
+                        await self.server.send_msg(self.server.clients[receiver].stream, msg, receiver)
                         self.logger.info(f"Send Command {command} to {receiver}")
                     else:
                         self.logger.error(f"Client {receiver} not found")
@@ -318,32 +399,30 @@ class ClientProcess(Process):
                 function = msg["function"]
                 if msg["result"]["responded"]:
                     if sender == "CBR":
+                        result = None
                         if "type" not in msg["result"].keys():
                             self.logger.warning(
                                 f"Unknown result of using api of {plugin} to {receiver} , you may update the version of CBR client")
-                            self.server.clients[self.current_client].cmd_result = None
                         elif msg["result"]["type"] == 0:
-                            self.server.clients[self.current_client].cmd_result = msg["result"]["result"]
+                            result = msg["result"]["result"]
                             self.logger.debug(
                                 f"Result of Command to {receiver} finished, result: {msg['result']['result']}", "CBR")
                         elif msg["result"]["type"] == 1:
-                            self.server.clients[self.current_client].cmd_result = None
                             self.logger.warning(f"Plugin {plugin} not find")
                         elif msg["result"]["type"] == 2:
-                            self.server.clients[self.current_client].cmd_result = None
                             self.logger.warning(f"Function {function} dose not exist in {plugin}")
                         elif msg["result"]["type"] == 3:
-                            self.server.clients[self.current_client].cmd_result = None
                             self.logger.warning(f"Other error exist")
-                        self.server.clients[self.current_client].cmd_lock.cancel()
+                        if not self.server.clients[self.current_client].resolve(msg.get("id"), result):
+                            self.logger.debug(f"No query waiting for result of api use of {plugin} to {receiver}", "CBR")
                     elif self.server.clients[sender].online:
-                        await self.server.send_msg(self.server.clients[sender].stream, json.dumps(msg), sender)
+                        await self.server.send_msg(self.server.clients[sender].stream, msg, sender)
                         self.logger.info(f"Result of api use of {plugin} send to {sender}")
                     else:
                         self.logger.error(f"Client {sender} is Closed")
                 else:
                     if self.server.clients[receiver].online:
-                        await self.server.send_msg(self.server.clients[receiver].stream, json.dumps(msg), receiver)
+                        await self.server.send_msg(self.server.clients[receiver].stream, msg, receiver)
                         self.logger.info(f"Result of api use of {plugin} send to {sender}")
                     else:
                         self.logger.error(f"Client {receiver} not found")
@@ -0,0 +1,114 @@
+"""
+    round trip time of clients, measured in background
+"""
+import trio
+
+from bisect import bisect_left
+from typing import TYPE_CHECKING
+
+from cbr.lib.logger import CBRLogger
+
+if TYPE_CHECKING:
+    from cbr.lib.client import Client
+    from cbr.net.network import Network
+
+# upper bound(ms) of each bucket in histogram, the last bucket is for the rest
+RTT_BUCKETS = [5, 10, 25, 50, 100, 250, 500, 1000]
+EWMA_ALPHA = 0.2
+
+
+class RTTStats:
+    """
+        Statistics of round trip time(ms) of one client
+    """
+    def __init__(self):
+        self.last = None
+        self.ewma = None
+        self.min = None
+        self.max = None
+        self.samples = 0
+        self.lost = 0
+        self.histogram = [0] * (len(RTT_BUCKETS) + 1)
+
+    def add(self, rtt):
+        self.last = rtt
+        if self.ewma is None:
+            self.ewma = rtt
+            self.min = rtt
+            self.max = rtt
+        else:
+            self.ewma += EWMA_ALPHA * (rtt - self.ewma)
+            self.min = min(self.min, rtt)
+            self.max = max(self.max, rtt)
+        self.samples += 1
+        self.histogram[bisect_left(RTT_BUCKETS, rtt)] += 1
+
+    def add_loss(self):
+        self.last = None
+        self.lost += 1
+
+    def histogram_text(self):
+        text = []
+        lower = 0
+        for i, count in enumerate(self.histogram):
+            if count != 0:
+                if i < len(RTT_BUCKETS):
+                    text.append(f"{lower}-{RTT_BUCKETS[i]}ms: {count}")
+                else:
+                    text.append(f">{lower}ms: {count}")
+            if i < len(RTT_BUCKETS):
+                lower = RTT_BUCKETS[i]
+        return ", ".join(text)
+
+    def to_dict(self):
+        return {
+            "last": self.last,
+            "ewma": self.ewma,
+            "min": self.min,
+            "max": self.max,
+            "samples": self.samples,
+            "lost": self.lost,
+            "histogram": dict(zip([str(i) for i in RTT_BUCKETS] + ["inf"], self.histogram))
+        }
+
+
+class RTTMonitor:
+    """
+        Ping all online clients every interval seconds and keep the result in Client.rtt
+    """
+    def __init__(self, network: "Network", logger: CBRLogger):
+        self.network = network
+        self.logger = logger
+        self.interval = network.network_config["rtt_interval"]
+        self.timeout = network.network_config["rtt_timeout"]
+
+    async def run(self):
+        if self.interval <= 0:
+            return
+        while True:
+            async with trio.open_nursery() as nursery:
+                for client in self.network.clients.values():
+                    if client.online:
+                        nursery.start_soon(self.probe, client)
+            await trio.sleep(self.interval)
+
+    async def probe(self, client: "Client"):
+        pong = trio.Event()
+        try:
+            # not in the timeout, the ping is written as a whole or the client is disconnected
+            start = await self.network.write_ping(client, pong)
+        except (trio.BrokenResourceError, trio.ClosedResourceError):
+            return
+        if start is None:
+            return
+        with trio.move_on_after(self.timeout):
+            await pong.wait()
+        if client.probe is not None and client.probe[1] is pong:
+            client.probe = None
+        if pong.is_set():
+            rtt = round((client.pong_time - start) * 1000, 1)
+            client.rtt.add(rtt)
+            self.logger.debug(f"Ping {client.name}: {rtt}ms", "CBR")
+        elif client.online:
+            client.rtt.add_loss()
+            self.logger.debug(f"No response from {client.name}", "CBR")
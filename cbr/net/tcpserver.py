@@ -1,4 +1,3 @@
-import json
 import trio
 
 from functools import partial
@@ -6,8 +5,12 @@ from functools import partial
 from cbr.lib.client import Client
 from cbr.lib.config import Config
 from cbr.lib.logger import CBRLogger
+from cbr.net.frame import FrameTooLargeError, RoutedFrame
+from cbr.net.keepalive import KeepAlive
+from cbr.net.presence import PresenceIndex, PresenceMonitor
 from cbr.net.network import Network
 from cbr.net.process import ServerProcess, ClientProcess
+from cbr.net.rtt import RTTMonitor
 from cbr.plugin.plugin import PluginManager
 from cbr.plugin.rtext import *
 
@@ -24,7 +27,11 @@ class CBRTCPServer(Network):
         self.ip = self.config.ip
         self.port = self.config.port
         self.clients = self.setup_client()
-        super().__init__(logger, self.config.aes_key, self.clients)
+        super().__init__(logger, self.config.aes_key, self.clients, self.config.network)
+        self.rtt_monitor = RTTMonitor(self, logger)
+        self.keepalive = KeepAlive(self, logger)
+        self.presence = PresenceIndex()
+        self.presence_monitor = PresenceMonitor(self, logger)
         self.plugin_manager = None
         self.process = None
         self.nursery = None
@@ -77,8 +84,12 @@ class CBRTCPServer(Network):
         try:
             async with trio.open_nursery() as self.nursery:
                 self.nursery.start_soon(self.start_server)
+                self.nursery.start_soon(self.rtt_monitor.run)
+                self.nursery.start_soon(self.keepalive.run)
+                self.nursery.start_soon(self.presence_monitor.run)
                 self.logger.info(f"The Server is now serving on {self.ip}:{self.port}")
                 await self.plugin_manager.reload_all_plugins()
+                self.nursery.start_soon(self.plugin_manager.watcher.run)
                 self.nursery.start_soon(partial(trio.to_thread.run_sync, self.input_process, cancellable=True))
         except KeyboardInterrupt:
             await self.stop()
@@ -95,47 +106,70 @@ class CBRTCPServer(Network):
             address = "ERROR ADDRESS"
         self.logger.debug(f"new session started from {address}", "CBR")
         client_process = ClientProcess(self, self.logger)
+        self.keepalive.register(client_process)
         async with trio.open_nursery() as nursery:
-            while not client_process.cancelled:
-                try:
-                    with trio.fail_after(120) as client_process.cancel_scope:
-                        await self.server_process(stream, client_process, address, nursery)
-                except trio.TooSlowError:
-                    if not client_process.cancelled:
-                        self.logger.error("Connection time out!")
-                    else:
-                        self.logger.debug("Cancel Process", "CBR")
-                    break
-                except trio.BrokenResourceError:
-                    self.logger.debug("Process broken", "CBR")
-                    break
-                except trio.ClosedResourceError:
-                    self.logger.debug("Process Closed", "CBR")
-                    break
-                except trio.Cancelled:
-                    self.logger.debug(f"Cancel Process to {client_process.current_client}", "CBR")
-                    break
-                except Exception:
-                    self.logger.bug()
-                    if client_process.current_client != "":
-                        self.logger.info(f"Closed Process to {client_process.current_client}")
-                    break
+            with client_process.cancel_scope:
+                await self.process_loop(stream, client_process, address, nursery)
+            if client_process.timed_out:
+                self.logger.error("Connection time out!")
+                await trio.aclose_forcefully(stream)
+            elif client_process.cancel_scope.cancelled_caught:
+                self.logger.debug("Cancel Process", "CBR")
+            self.keepalive.unregister(client_process)
             client_process.cancelled = True
             if client_process.current_client != "":
-                self.clients[client_process.current_client].online = False
+                client = self.clients[client_process.current_client]
+                if client.queue is not None and client.queue.stream is stream:
+                    client.queue.abort()
+                if client.stream is stream:
+                    client.cancel_pending()
+                    self.presence.clear(client.name)
+                client.online = False
+
+    async def process_loop(self, stream: trio.SocketStream, client_process: ClientProcess, address, nursery):
+        while not client_process.cancelled:
+            try:
+                await self.server_process(stream, client_process, address, nursery)
+            except trio.BrokenResourceError:
+                self.logger.debug("Process broken", "CBR")
+                if client_process.current_client != "" and self.clients[client_process.current_client].online:
+                    self.logger.info(f"Connection lost from {client_process.current_client}")
+                break
+            except trio.ClosedResourceError:
+                self.logger.debug("Process Closed", "CBR")
+                break
+            except FrameTooLargeError as err:
+                source = address
+                if client_process.current_client != "":
+                    source = client_process.current_client
+                self.logger.warning(f"{err}, disconnect {source}")
+                await trio.aclose_forcefully(stream)
+                break
+            except trio.Cancelled:
+                self.logger.debug(f"Cancel Process to {client_process.current_client}", "CBR")
+                break
+            except Exception:
+                self.logger.bug()
+                if client_process.current_client != "":
+                    self.logger.info(f"Closed Process to {client_process.current_client}")
+                break
 
     async def server_process(self, stream: trio.SocketStream, client_process: ClientProcess, address, nursery):
-        msg = await self.receive_msg(stream, address)
-        try:
-            msg = json.loads(msg)
-        except Exception:
-            await self.send_stop(stream)
-            self.logger.info(f"Failed decode message from {address}, please check encryption keys")
-            self.logger.bug(error=False)
-            self.logger.info(f"message: {msg}")
-            await stream.aclose()
-            return
-        await client_process.process_msg(msg, stream, address, nursery)
+        msgs = await self.receive_msg(stream, address, client_process.decoder, client_process.frame_ciphers)
+        client_process.last_seen = trio.current_time()
+        for msg in msgs:
+            if isinstance(msg, RoutedFrame):
+                if await client_process.relay_frame(msg):
+                    continue
+                msg = await self.decode_msg(msg.frame, client_process.frame_ciphers)
+            if msg is None:
+                await self.send_stop(stream)
+                self.logger.info(f"Failed decode message from {address}, please check encryption keys")
+                await stream.aclose()
+                return
+            await client_process.process_msg(msg, stream, address, nursery)
+            if client_process.cancelled:
+                return
 
     def input_process(self):
         while not self.process.cancelled:
@@ -6,6 +6,7 @@ import trio
 
 from typing import TYPE_CHECKING
 
+from cbr.net.network import SEND_OK, SEND_OFFLINE
 from cbr.resources import formatter
 from cbr.plugin.rtext import rtext_json_to_text
 
@@ -18,31 +19,39 @@ if TYPE_CHECKING:
 class CBRInterfaceLogger:
     """
         simple logger for server_interface, recommend to use this logger instead of CBRLogger
+
+        token is None if it is used in the trio loop by async plugins
     """
-    def __init__(self, logger: "CBRLogger", token: trio.lowlevel.TrioToken):
+    def __init__(self, logger: "CBRLogger", token: trio.lowlevel.TrioToken = None):
         self.__logger = logger
         self.__token = token
         self.__formatter = formatter
 
+    def __log(self, log, *args):
+        if self.__token is None:
+            log(*args)
+        else:
+            trio.from_thread.run_sync(log, *args, trio_token=self.__token)
+
     def chat(self, msg):
         msg = self.__formatter.no_color_formatter(msg)
-        trio.from_thread.run_sync(self.__logger.chat, msg, trio_token=self.__token)
+        self.__log(self.__logger.chat, msg)
 
     def info(self, msg):
         msg = self.__formatter.no_color_formatter(msg)
-        trio.from_thread.run_sync(self.__logger.info, msg, trio_token=self.__token)
+        self.__log(self.__logger.info, msg)
 
     def error(self, msg):
         msg = self.__formatter.no_color_formatter(msg)
-        trio.from_thread.run_sync(self.__logger.error, msg, trio_token=self.__token)
+        self.__log(self.__logger.error, msg)
 
     def warning(self, msg):
         msg = self.__formatter.no_color_formatter(msg)
-        trio.from_thread.run_sync(self.__logger.warning, msg, trio_token=self.__token)
+        self.__log(self.__logger.warning, msg)
 
     def debug(self, msg):
         msg = self.__formatter.no_color_formatter(msg)
-        trio.from_thread.run_sync(self.__logger.debug, msg, "plugin", trio_token=self.__token)
+        self.__log(self.__logger.debug, msg, "plugin")
 
 
 class CBRInterface:
@@ -51,14 +60,13 @@ class CBRInterface:
         self.__token = token
         self.cbr_logger: "CBRLogger" = server.logger
         self.logger = CBRInterfaceLogger(self.cbr_logger, token)
-        self.__result_cache = None
-        self.__current_plugin_id = plugin_id
+        self._current_plugin_id = plugin_id
 
     def is_client_online(self, client):
         """
             Check clients online or not
         """
-        if self.__exist(client):
+        if self._exist(client):
             return self._server.clients[client].online
         else:
             return False
@@ -67,7 +75,7 @@ class CBRInterface:
         """
             Check clients register for type `mc` or not
         """
-        if self.__exist(client) and self._server.clients[client].type == "mc":
+        if self._exist(client) and self._server.clients[client].type == "mc":
             return True
         else:
             return False
@@ -109,6 +117,38 @@ class CBRInterface:
         if client in self._server.clients.keys():
             return self._server.clients[client].type
 
+    def get_client_rtt(self, client):
+        """
+            get round trip time(ms) statistics of client measured in background, if not register return None
+
+            dict with last, ewma, min, max, samples, lost and histogram, last is None if the last ping is lost
+        """
+        if self._exist(client):
+            return self._server.clients[client].rtt.to_dict()
+        return None
+
+    def get_players(self, client):
+        """
+            get list of online players in client, kept from joined and left messages without any query
+        """
+        return sorted(self._server.presence.get_players(client), key=str.lower)
+
+    def find_player(self, player):
+        """
+            get the client that player is online in, if not found return None
+        """
+        return self._server.presence.find_player(player)
+
+    def get_plugin_stats(self, plugin_id=None):
+        """
+            get latency statistics of events of plugin, dict of event and statistics, None if plugin not exist
+
+            statistics is dict with calls, timeouts, errors, p50, p95, p99, max, avg and histogram, latency is in ms
+
+            get dict of plugin id and its statistics of all plugins if plugin_id is None
+        """
+        return self._server.plugin_manager.get_plugin_stats(plugin_id)
+
     def send_message(self, target, msg):  # TODO: send to all client
         """
             send message to target client
@@ -117,10 +157,15 @@ class CBRInterface:
 
     def tell_message(self, target, receiver, msg):
         """
-            send message to receiver in target client
+            send message to receiver in target client, target can be None to send to the client receiver is online in
 
             may not useful in some specific client type
         """
+        if target is None:
+            target = self.find_player(receiver)
+            if target is None:
+                self.logger.error(f"player {receiver} not found")
+                return
         self.send_custom_message("CBR", target, msg, receiver=receiver)
 
     def reply(self, info: "MessageInfo", msg):
@@ -135,30 +180,32 @@ class CBRInterface:
         """
             send message to target client with custom information
         """
-        if not self.__running():
+        if not self._running():
             return
-        if target == "CBR":
-            self.__split_log(re.sub("§.", "", str(msg)))
-            return
-        if self.is_client_online(target):
-            if hasattr(msg, "to_json_str"):
-                if self.is_mc_client(target):
-                    msg = msg.to_json_str()
-                else:
-                    msg = rtext_json_to_text(msg.to_json_str())
-            elif not self.is_mc_client(target):
-                msg = re.sub("§.", "", msg)
+        messages, _ = self._prepare_messages([target], msg)
+        if target in messages.keys():
             stream = self._server.clients[target].stream
-            trio.from_thread.run(self._server.send_message, stream, self_client, source_player, msg, receiver, target, trio_token=self.__token)
-        else:
-            self.logger.error(f"client {target} not found or not connected")
+            trio.from_thread.run(self._server.send_message, stream, self_client, source_player, messages[target], receiver, target, trio_token=self.__token)
         # TODO: raise Error(to be confirm)
 
+    def send_custom_messages(self, self_client, targets: list, msg, source_player="", receiver=""):
+        """
+            send message to many target clients at the same time with custom information
+
+            return dict of target and delivery status, `sent`, `queued`, `dropped`, `offline`, `closed` or `timeout`
+        """
+        if not self._running():
+            return None
+        messages, results = self._prepare_messages(targets, msg)
+        if len(messages) != 0:
+            results.update(trio.from_thread.run(self._server.send_messages, messages, self_client, source_player, receiver, trio_token=self.__token))
+        return results
+
     def execute_command(self, target, command):
         """
             execute command in a cbr client without return
         """
-        if not self.__running():
+        if not self._running():
             return None
         if self.is_client_online(target):
             stream = self._server.clients[target].stream
@@ -171,7 +218,7 @@ class CBRInterface:
             execute mcdr command in a cbr client without return
         """
         # TODO: split mcdr command and normal command
-        if not self.__running():
+        if not self._running():
             return
         if self.is_client_online(target):
             stream = self._server.clients[target].stream
@@ -179,21 +226,23 @@ class CBRInterface:
         else:
             self.logger.error(f"client {target} not found or not connected")
 
-    def command_query(self, target, command):
+    def command_query(self, target, command, cache_ttl=None):
         """
             execute command in a cbr client with return
 
+            set cache_ttl to share the result with the same query from any plugin in flight or in cache_ttl seconds
+
             return None if timeout or Error
         """
-        if not self.__running():
+        if not self._running():
             return None
         if self.is_client_online(target):
-            return trio.from_thread.run(self.__wait_cmd_result, target, command, trio_token=self.__token)
+            return trio.from_thread.run(self._wait_cmd_result, target, command, cache_ttl, trio_token=self.__token)
         else:
             self.logger.error(f"client {target} not found or not connected")
             return None
 
-    def servers_command_query(self, targets: list, command):
+    def servers_command_query(self, targets: list, command, cache_ttl=None):
         """
             query for get the result of multi servers
 
@@ -204,11 +253,13 @@ class CBRInterface:
 
             targets can't be string
 
+            cache_ttl is same as command_query
+
             return None in dict if it can't get result
         """
-        if not self.__running():
+        if not self._running():
             return None
-        return trio.from_thread.run(self.__wait_servers_cmd_result, targets, command, trio_token=self.__token)
+        return trio.from_thread.run(self._wait_servers_cmd_result, targets, command, cache_ttl, trio_token=self.__token)
 
     def api_query(self, target, plugin_id, function_name, keys: list):
         """
@@ -219,10 +270,10 @@ class CBRInterface:
             key is a list that store string, dict or bool
         """
         pass
-        if not self.__running():
+        if not self._running():
             return None
         if self.is_client_online(target):
-            return trio.from_thread.run(self.__wait_api_result, target, plugin_id, function_name, keys, trio_token=self.__token)
+            return trio.from_thread.run(self._server.api_query, target, plugin_id, function_name, keys, trio_token=self.__token)
         else:
             self.logger.error(f"client {target} not found or not connected")
             return None
@@ -231,54 +282,145 @@ class CBRInterface:
         """
             register help message for command `##help`
         """
-        self._server.add_register_help_msg(self.__current_plugin_id, prefix, msg)
+        self._server.add_register_help_msg(self._current_plugin_id, prefix, msg)
 
-    def __running(self):
+    def _running(self):
         if self._server.server_running is False:
             self.logger.error("Server closed, not allow to send anything")
             return False
         return True
 
-    def __exist(self, target):
+    def _exist(self, target):
         if target in self._server.clients:
             return True
         else:
             return False
 
-    def __split_log(self, msg):
+    def _convert_msg(self, target, msg):
+        if hasattr(msg, "to_json_str"):
+            if self.is_mc_client(target):
+                return msg.to_json_str()
+            return rtext_json_to_text(msg.to_json_str())
+        elif not self.is_mc_client(target):
+            return re.sub("§.", "", msg)
+        return msg
+
+    def _prepare_messages(self, targets: list, msg):
+        """
+            msg converted for each online target, and delivery status of targets it is not sent to
+
+            messages to CBR are logged here, shared by CBRInterface and AsyncCBRInterface
+        """
+        messages = {}
+        results = {}
+        for target in targets:
+            if target == "CBR":
+                self._split_log(re.sub("§.", "", str(msg)))
+                results[target] = SEND_OK
+            elif self.is_client_online(target):
+                messages[target] = self._convert_msg(target, msg)
+            else:
+                self.logger.error(f"client {target} not found or not connected")
+                results[target] = SEND_OFFLINE
+        return messages, results
+
+    def _split_log(self, msg):
         for i in msg.splitlines():
-            if self.__current_plugin_id == "ChatBridgeReforged":
+            if self._current_plugin_id == "ChatBridgeReforged":
                 self.logger.chat(i)
             else:
                 self.logger.chat("- " + i)
 
-    async def __wait_api_result(self, target, plugin_id, function_name, keys):
-        with trio.move_on_after(2) as self._server.clients[target].cmd_lock:
-            self._server.clients[target].cmd_result = None
-            stream = self._server.clients[target].stream
-            await self._server.send_api(stream, target, plugin_id, function_name, keys, target)
-            await trio.sleep(2)
-        return self._server.clients[target].cmd_result
-
-    async def __wait_servers_cmd_result(self, targets, cmd):
-        self.__result_cache = {}
+    async def _wait_servers_cmd_result(self, targets, cmd, cache_ttl):
+        results = {}
         async with trio.open_nursery() as nursery:
             for i in targets:
-                nursery.start_soon(self.__cache_commands_result, i, cmd)
-        results = self.__result_cache
-        self.__result_cache = None
+                nursery.start_soon(self._cache_commands_result, i, cmd, cache_ttl, results)
+        return results
+
+    async def _cache_commands_result(self, target, cmd, cache_ttl, results: dict):
+        results[target] = await self._wait_cmd_result(target, cmd, cache_ttl)
+
+    async def _wait_cmd_result(self, target, cmd, cache_ttl=None):
+        if self._exist(target):
+            if cache_ttl is not None:
+                return await self._server.cached_command_query(target, cmd, cache_ttl)
+            return await self._server.command_query(target, cmd)
+        else:
+            self.logger.error(f"client {target} not found or not connected")
+            return None
+
+
+class AsyncCBRInterface(CBRInterface):
+    """
+        CBRInterface for `async def` plugin events, which run in the trio loop instead of a thread
+
+        functions sending anything are coroutines and have to be awaited, the others are same as CBRInterface
+    """
+    def __init__(self, server: "CBRTCPServer", plugin_id):
+        super().__init__(server, server.token, plugin_id)
+        self.logger = CBRInterfaceLogger(self.cbr_logger)
+
+    async def send_message(self, target, msg):
+        await self.send_custom_message("CBR", target, msg)
+
+    async def tell_message(self, target, receiver, msg):
+        if target is None:
+            target = self.find_player(receiver)
+            if target is None:
+                self.logger.error(f"player {receiver} not found")
+                return
+        await self.send_custom_message("CBR", target, msg, receiver=receiver)
+
+    async def reply(self, info: "MessageInfo", msg):
+        await self.send_custom_message("CBR", info.source_client, msg, receiver=info.sender)
+
+    async def send_custom_message(self, self_client, target, msg, source_player="", receiver=""):
+        if not self._running():
+            return
+        messages, _ = self._prepare_messages([target], msg)
+        if target in messages.keys():
+            stream = self._server.clients[target].stream
+            await self._server.send_message(stream, self_client, source_player, messages[target], receiver, target)
+
+    async def send_custom_messages(self, self_client, targets: list, msg, source_player="", receiver=""):
+        if not self._running():
+            return None
+        messages, results = self._prepare_messages(targets, msg)
+        if len(messages) != 0:
+            results.update(await self._server.send_messages(messages, self_client, source_player, receiver))
         return results
 
-    async def __cache_commands_result(self, target, cmd):
-        self.__result_cache.update({target: await self.__wait_cmd_result(target, cmd)})
+    async def execute_command(self, target, command):
+        if not self._running():
+            return None
+        if self.is_client_online(target):
+            await self._server.send_command(self._server.clients[target].stream, command, target)
+        else:
+            self.logger.error(f"client {target} not found or not connected")
+
+    async def execute_mcdr_command(self, target, command):
+        await self.execute_command(target, command)
+
+    async def command_query(self, target, command, cache_ttl=None):
+        if not self._running():
+            return None
+        if self.is_client_online(target):
+            return await self._wait_cmd_result(target, command, cache_ttl)
+        else:
+            self.logger.error(f"client {target} not found or not connected")
+            return None
+
+    async def servers_command_query(self, targets: list, command, cache_ttl=None):
+        if not self._running():
+            return None
+        return await self._wait_servers_cmd_result(targets, command, cache_ttl)
 
-    async def __wait_cmd_result(self, target, cmd):
-        if self.__exist(target):
-            with trio.move_on_after(2) as self._server.clients[target].cmd_lock:
-                self._server.clients[target].cmd_result = None
-                await self._server.send_command(self._server.clients[target].stream, cmd, target)
-                await trio.sleep(2)
-            return self._server.clients[target].cmd_result
+    async def api_query(self, target, plugin_id, function_name, keys: list):
+        if not self._running():
+            return None
+        if self.is_client_online(target):
+            return await self._server.api_query(target, plugin_id, function_name, keys)
         else:
             self.logger.error(f"client {target} not found or not connected")
             return None
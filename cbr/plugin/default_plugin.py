@@ -11,7 +11,7 @@ import trio
 
 from cbr.lib.config import CHATBRIDGEREFORGED_VERSION
 from cbr.plugin.info import MessageInfo
-from cbr.plugin.cbrinterface import CBRInterface
+from cbr.plugin.cbrinterface import AsyncCBRInterface, CBRInterface
 from cbr.net.process import ServerProcess
 from cbr.resources import formatter
 
@@ -21,21 +21,23 @@ METADATA = {
     "name": "ChatBridgeReforged",
     "description": "The core of CBR",
     "author": "Ricky",
-    "link": "https://github.com/R1ckyH/ChatBridgeReforged"
+    "link": "https://github.com/R1ckyH/ChatBridgeReforged",
+    "message_filter": {"prefixes": ["##CBR", "##help"]},
+    "priority": 0
 }
 
 
-async def reply(server: CBRInterface, info: MessageInfo, msg, chat=False):
+async def reply(server: AsyncCBRInterface, info: MessageInfo, msg, chat=False):
     msg = "§7[§6CBR§7] " + msg
     if info.source_client == "CBR" and not chat:
         msg = formatter.no_color_formatter(msg)
         for i in msg.splitlines():
             server.cbr_logger.info(i)
     else:
-        await trio.to_thread.run_sync(server.reply, info, msg)
+        await server.reply(info, msg)
 
 
-async def unknown_cmd(command, server: CBRInterface, info: MessageInfo):
+async def unknown_cmd(command, server: AsyncCBRInterface, info: MessageInfo):
     if command != "":
         command = " " + command
     command = "##CBR" + command
@@ -62,7 +64,7 @@ def reload_result(loaded_plugin, unloaded_plugin, reloaded_plugin, failed_plugin
 
 
 # TODO: permission system(may do)
-async def msg_process(self: ServerProcess, msg: str, nursery: trio.Nursery, server: CBRInterface, info: MessageInfo, command=False):
+async def msg_process(self: ServerProcess, msg: str, nursery: trio.Nursery, server: AsyncCBRInterface, info: MessageInfo, command=False):
     args = msg.split(" ")
     length = len(args)
     if args[0] == "help" or args[0] == "?" or args[0] == "":
@@ -95,17 +97,23 @@ async def msg_process(self: ServerProcess, msg: str, nursery: trio.Nursery, serv
             await reply(server, info, self.get_status(), chat=True)
         elif args[1] == "ping":
             if length == 2:
-                message = await self.ping_all()
+                message = self.ping_all()
                 await reply(server, info, "Ping clients:" + message, chat=True)
             else:
                 if length > 2 and args[2] in self.server.clients.keys():
-                    ping = await self.ping_test(args[2])
-                    await reply(server, info, self.ping_log(ping, args[2]), chat=True)
+                    await reply(server, info, self.ping_detail(args[2]), chat=True)
                 else:
                     await reply(server, info, "Client not found", chat=True)
+        elif args[1] == "plugin" or args[1] == "plg":
+            if length == 2:
+                await reply(server, info, self.plugin_status(), chat=True)
+            elif args[2] == "dump" and args[2] not in self.plugin_manager.plugins.keys():
+                await reply(server, info, await self.dump_plugin_stats(), chat=True)
+            else:
+                await reply(server, info, self.plugin_status(args[2]), chat=True)
         elif args[1] == "all":
             msg = self.get_status()
-            msg += await self.ping_all()
+            msg += self.ping_all()
             await reply(server, info, msg, chat=True)
         else:
             await unknown_cmd("status", server, info)
@@ -200,25 +208,22 @@ async def msg_process(self: ServerProcess, msg: str, nursery: trio.Nursery, serv
     return True
 
 
-def run_process(server: CBRInterface, info: MessageInfo, command=False):
+async def run_process(server: AsyncCBRInterface, info: MessageInfo, command=False):
     msg = info.content.replace("##CBR ", "").replace("##CBR", "")
     cbr_server = server._server
-    process = cbr_server.process
-    nursery = cbr_server.nursery
-    token = cbr_server.token
-    trio.from_thread.run(msg_process, process, msg, nursery, server, info, command, trio_token=token)
+    await msg_process(cbr_server.process, msg, cbr_server.nursery, server, info, command)
 
 
-def on_message(server: CBRInterface, info: MessageInfo):
+async def on_message(server: AsyncCBRInterface, info: MessageInfo):
     if info.content == "##help":
-        server.reply(info, server._server.get_register_help_msg())
+        await server.reply(info, server._server.get_register_help_msg())
     if info.content.startswith("##CBR") and info.client_type == "mc":  # for some reason, only mc client can access now
         info.cancel_send_message()
-        run_process(server, info)
+        await run_process(server, info)
 
 
-def on_command(server: CBRInterface, info: MessageInfo):  # not recommend doing, but you can do it
-    run_process(server, info, command=True)
+async def on_command(server: AsyncCBRInterface, info: MessageInfo):  # not recommend doing, but you can do it
+    await run_process(server, info, command=True)
 
 
 def on_load(server: CBRInterface):
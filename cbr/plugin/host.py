@@ -0,0 +1,169 @@
+"""
+    run plugin in another process, for plugins with "isolation": "process" in METADATA
+"""
+import ast
+import inspect
+import json
+import subprocess
+import sys
+import trio
+
+from cbr.lib.logger import CBRLogger
+from cbr.plugin.cbrinterface import AsyncCBRInterface
+from cbr.plugin.host_process import decode_value, encode_value
+from cbr.plugin.info import MessageInfo
+
+ISOLATION_PROCESS = "process"
+# seconds for the process to import the plugin and send ready
+START_TIMEOUT = 30
+
+
+class PluginHostError(RuntimeError):
+    pass
+
+
+def read_metadata(path):
+    """
+        METADATA of plugin without importing it, None if it is not a literal
+    """
+    try:
+        with open(path, "r", encoding="utf-8") as file:
+            tree = ast.parse(file.read(), path)
+    except (OSError, SyntaxError, ValueError):
+        return None
+    for node in tree.body:
+        if isinstance(node, ast.Assign) and any(isinstance(i, ast.Name) and i.id == "METADATA" for i in node.targets):
+            try:
+                return ast.literal_eval(node.value)
+            except ValueError:
+                return None
+    return None
+
+
+class PluginHost:
+    """
+        A plugin running in its own process, so it does not share GIL with the network of CBR
+
+        only one event runs in the process at the same time, the others wait for the lock
+    """
+    def __init__(self, path, name, logger: CBRLogger):
+        self.path = path
+        self.name = name
+        self.logger = logger
+        self.process = None
+        self.buffer = bytearray()
+        self.lock = trio.Lock()
+        self.event_ids = 0
+
+    async def start(self):
+        """
+            start the process and return the events and METADATA of plugin
+        """
+        self.buffer = bytearray()
+        self.process = await trio.lowlevel.open_process(
+            [sys.executable, "-m", "cbr.plugin.host_process", self.path, self.name],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            with trio.fail_after(START_TIMEOUT):
+                msg = await self.__receive()
+        except trio.TooSlowError:
+            await self.stop(wait_time=0)
+            raise PluginHostError(f"Fail to start process of plugin {self.name}: not ready after {START_TIMEOUT}s")
+        if msg is None or msg["type"] != "ready":
+            await self.stop()
+            error = "process exited" if msg is None else msg["error"]
+            raise PluginHostError(f"Fail to start process of plugin {self.name}: {error}")
+        self.logger.debug(f"Process of plugin {self.name} started at pid {self.process.pid}", "plugin")
+        return msg["events"], msg["metadata"]
+
+    async def stop(self, wait_time=1):
+        if self.process is None:
+            return
+        process = self.process
+        self.process = None
+        with trio.move_on_after(wait_time):
+            try:
+                await process.stdin.send_all(b'{"type": "stop"}\n')
+            except (trio.BrokenResourceError, trio.ClosedResourceError):
+                pass
+            await process.wait()
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        await process.stdin.aclose()
+        await process.stdout.aclose()
+
+    async def __send(self, msg: dict):
+        await self.process.stdin.send_all(json.dumps(msg).encode("utf-8") + b"\n")
+
+    async def __receive(self):
+        while b"\n" not in self.buffer:
+            data = await self.process.stdout.receive_some()
+            if not data:
+                return None
+            self.buffer += data
+        index = self.buffer.index(b"\n")
+        line = bytes(self.buffer[:index])
+        del self.buffer[:index + 1]
+        return json.loads(line)
+
+    async def run_event(self, event, server_interface: AsyncCBRInterface, *args):
+        """
+            run event in the process, calls of CBRInterface from the process are done with server_interface
+        """
+        async with self.lock:
+            if self.process is None:
+                raise PluginHostError(f"Process of plugin {self.name} is not running")
+            self.event_ids += 1
+            try:
+                await self.__send({"type": "event", "id": self.event_ids, "event": event, "args": encode_value(args)})
+                while True:
+                    msg = await self.__receive()
+                    if msg is None:
+                        raise PluginHostError(f"Process of plugin {self.name} exited while running '{event}'")
+                    if msg["type"] == "done":
+                        break
+                    await self.__send(await self.__call(server_interface, msg))
+            except BaseException:
+                # the process is in the middle of an event, it can not be used anymore
+                self.process.kill()
+                self.process = None
+                raise
+        info = [i for i in args if isinstance(i, MessageInfo)]
+        if len(info) != 0 and msg["send"] is False:
+            info[0].cancel_send_message()
+        if msg["error"] is not None:
+            raise PluginHostError(f"'{event}' of plugin {self.name} failed in process: {msg['error']}")
+
+    async def __call(self, server_interface: AsyncCBRInterface, msg: dict):
+        target = server_interface
+        method = msg["method"]
+        if method.startswith("logger."):
+            target = server_interface.logger
+            method = method[7:]
+        if method.startswith("_") or not hasattr(target, method):
+            return {"type": "result", "id": msg["id"], "error": f"Function {msg['method']} not found"}
+        try:
+            result = getattr(target, method)(*decode_value(msg["args"], self.logger))
+            if inspect.isawaitable(result):
+                result = await result
+        except Exception as e:
+            self.logger.bug()
+            return {"type": "result", "id": msg["id"], "error": repr(e)}
+        return {"type": "result", "id": msg["id"], "result": encode_value(result)}
+
+
+class HostedPlugin:
+    """
+        Instance of plugin with isolation, events are coroutines which run the event in the process
+    """
+    def __init__(self, host: PluginHost, events: list, metadata: dict):
+        self.METADATA = metadata
+        for event in events:
+            setattr(self, event, self.__event(host, event))
+
+    @staticmethod
+    def __event(host: PluginHost, event):
+        async def run(server_interface: AsyncCBRInterface, *args):
+            await host.run_event(event, server_interface, *args)
+        return run
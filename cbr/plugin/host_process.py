@@ -0,0 +1,138 @@
+"""
+    process of a plugin with "isolation": "process", started by PluginHost
+
+    messages are json lines, events come from stdin, calls of CBRInterface and results of events go to stdout
+"""
+import importlib.util
+import inspect
+import json
+import os
+import sys
+import traceback
+
+from cbr.plugin.info import MessageInfo
+
+
+def encode_value(value):
+    if isinstance(value, MessageInfo):
+        return {"__info__": [value.source_client, value.content, value.sender, value.client_type, value.is_send_message()]}
+    elif isinstance(value, (list, tuple)):
+        return [encode_value(i) for i in value]
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+    return value
+
+
+def decode_value(value, logger=None):
+    if isinstance(value, dict) and "__info__" in value.keys():
+        source_client, content, sender, client_type, send = value["__info__"]
+        info = MessageInfo(source_client, content, sender, client_type, logger)
+        info._send_to_servers = send
+        return info
+    elif isinstance(value, list):
+        return [decode_value(i, logger) for i in value]
+    return value
+
+
+class HostChannel:
+    def __init__(self, output):
+        self.output = output
+        self.call_ids = 0
+
+    def send(self, msg: dict):
+        self.output.write(json.dumps(msg, default=str) + "\n")
+        self.output.flush()
+
+    def receive(self):
+        line = sys.stdin.readline()
+        if line == "":
+            return {"type": "stop"}
+        return json.loads(line)
+
+    def call(self, method, args):
+        """
+            call CBRInterface in CBR and wait for the result, CBR sends nothing else before the result
+        """
+        self.call_ids += 1
+        self.send({"type": "call", "id": self.call_ids, "method": method, "args": encode_value(args)})
+        msg = self.receive()
+        if msg["type"] == "stop":
+            raise SystemExit(0)
+        if "error" in msg.keys():
+            raise RuntimeError(msg["error"])
+        return decode_value(msg["result"], RemoteLogger(self))
+
+
+class RemoteLogger:
+    def __init__(self, channel: HostChannel):
+        self.__channel = channel
+
+    def chat(self, msg):
+        self.__channel.call("logger.chat", [msg])
+
+    def info(self, msg):
+        self.__channel.call("logger.info", [msg])
+
+    def error(self, msg):
+        self.__channel.call("logger.error", [msg])
+
+    def warning(self, msg):
+        self.__channel.call("logger.warning", [msg])
+
+    def debug(self, msg, module=None):
+        self.__channel.call("logger.debug", [msg])
+
+
+class RemoteCBRInterface:
+    """
+        CBRInterface in the plugin process, every function is called in CBR and returns its result
+    """
+    def __init__(self, channel: HostChannel):
+        self.__channel = channel
+        self.logger = RemoteLogger(channel)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def call(*args):
+            return self.__channel.call(name, list(args))
+        return call
+
+
+def main():
+    path, name = sys.argv[1], sys.argv[2]
+    # stdout of the process is the channel, print of plugin goes to stderr
+    channel = HostChannel(os.fdopen(os.dup(sys.stdout.fileno()), "w", encoding="utf-8"))
+    sys.stdout = sys.stderr
+    sys.path.append("plugins/")
+    try:
+        spec = importlib.util.spec_from_file_location(name, path)
+        instance = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(instance)
+    except Exception as e:
+        channel.send({"type": "error", "error": repr(e)})
+        raise
+    # async functions are not supported, there is no event loop in the process
+    events = [i for i in dir(instance) if i.startswith("on_") and callable(getattr(instance, i))
+              and not inspect.iscoroutinefunction(getattr(instance, i))]
+    channel.send({"type": "ready", "events": events, "metadata": getattr(instance, "METADATA", {})})
+    server = RemoteCBRInterface(channel)
+    logger = RemoteLogger(channel)
+    while True:
+        msg = channel.receive()
+        if msg["type"] == "stop":
+            break
+        args = decode_value(msg["args"], logger)
+        error = None
+        try:
+            getattr(instance, msg["event"])(server, *args)
+        except Exception as e:
+            traceback.print_exc()
+            error = repr(e)
+        infos = [i.is_send_message() for i in args if isinstance(i, MessageInfo)]
+        channel.send({"type": "done", "id": msg["id"], "error": error, "send": infos[0] if infos else None})
+
+
+if __name__ == "__main__":
+    main()
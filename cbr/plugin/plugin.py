@@ -8,7 +8,11 @@ import os
 import trio
 
 from cbr.lib.logger import CBRLogger
-from cbr.plugin.plugin_event import PluginEventManager
+from cbr.plugin.host import HostedPlugin, ISOLATION_PROCESS, PluginHost, read_metadata
+from cbr.plugin.plugin_event import PluginEventManager, PluginWorker
+from cbr.plugin.router import MessageFilter
+from cbr.plugin.stats import PluginStats
+from cbr.plugin.watcher import PluginWatcher
 
 from typing import TYPE_CHECKING
 
@@ -17,11 +21,29 @@ if TYPE_CHECKING:
 
 
 class Plugin:
-    def __init__(self, logger: CBRLogger, path, name):
+    def __init__(self, logger: CBRLogger, path, name, plugin_config: dict):
         self.logger = logger
         self.path_name = path
         self.name = name
+        self.plugin_config = plugin_config
+        self.worker = PluginWorker(plugin_config["max_threads"], plugin_config["max_queued"])
+        self.interface = None
+        self.async_interface = None
+        # shared by every load of the plugin, set by PluginManager once the id is known
+        self.stats = None
+        # seconds to import the plugin, reported at startup
+        self.import_time = 0
         self.metadata = self.__get_default_metadata()
+        self.host = None
+        metadata = read_metadata(path)
+        if isinstance(metadata, dict) and metadata.get("isolation") == ISOLATION_PROCESS:
+            # imported in its own process by start_host
+            self.host = PluginHost(path, name, logger)
+            self.instance = None
+            self.metadata.update(metadata)
+            self.last_edit_time = os.path.getmtime(path)
+            self.setup()
+            return
         try:
             self.last_edit_time = os.path.getmtime(path)
             self.spec = importlib.util.spec_from_file_location(name, path)
@@ -43,7 +65,42 @@ class Plugin:
         self.description = self.get_data("description")
         self.author = self.get_data("author")
         self.link = self.get_data("link")
-        self.dependencies = self.get_data("dependencies")
+        self.dependencies = self.__get_dependencies()
+        self.priority = None
+        if "priority" in self.metadata.keys():
+            try:
+                self.priority = int(self.metadata["priority"])
+            except (TypeError, ValueError):
+                self.logger.error(f"Invalid priority in METADATA of {self.id}, run it as observer")
+        self.message_filter = None
+        if isinstance(self.metadata.get("message_filter"), dict):
+            self.message_filter = MessageFilter(self.metadata["message_filter"])
+        self.worker.set_max_threads(self.__get_max_threads())
+
+    def __get_max_threads(self):
+        max_threads = self.plugin_config["max_threads"]
+        if "max_threads" not in self.metadata.keys():
+            return max_threads
+        try:
+            max_threads = int(self.metadata["max_threads"])
+        except (TypeError, ValueError):
+            self.logger.error(f"Invalid max_threads in METADATA of {self.id}, use {max_threads}")
+            return max_threads
+        if max_threads < 1:
+            self.logger.error(f"max_threads in METADATA of {self.id} should be at least 1, use 1")
+            return 1
+        return max_threads
+
+    def __get_dependencies(self):
+        """
+            ids of plugins that should be loaded before this one, versions like MCDR's {"id": ">=1.0"} are ignored
+        """
+        dependencies = self.metadata.get("dependencies")
+        if dependencies is None:
+            return []
+        if isinstance(dependencies, str):
+            return [dependencies]
+        return [str(i) for i in dependencies]
 
     def check_change(self):
         last_edit_time = os.path.getmtime(self.path_name)
@@ -52,6 +109,20 @@ class Plugin:
         else:
             return False
 
+    async def start_host(self):
+        """
+            (re)start the process of plugin with isolation
+        """
+        await self.host.stop()
+        try:
+            events, metadata = await self.host.start()
+        except Exception as e:
+            self.logger.bug()
+            raise e
+        self.instance = HostedPlugin(self.host, events, metadata)
+        self.last_edit_time = os.path.getmtime(self.path_name)
+        self.setup()
+
     def reload(self):
         try:
             self.spec.loader.exec_module(self.instance)
@@ -96,6 +167,10 @@ class PluginManager:
         self.event_manager = PluginEventManager(server, logger)
         self.plugins = {}
         self.plugin_dir = {}
+        # statistics of plugin id, kept after the plugin is unloaded so a reload does not clear them
+        self.stats = {}
+        self.reload_lock = trio.Lock()
+        self.watcher = PluginWatcher(self, logger, server.config.plugin)
 
     @staticmethod
     async def __get_plugin_path_list():
@@ -115,9 +190,19 @@ class PluginManager:
     async def get_loaded_plugins(self):
         plugins = []
         for i in self.plugins.values():
-            plugins.append(f"§r{i.name}: §7[{i.id}@{i.version}]")
+            plugins.append(f"§r{i.name}: §7[{i.id}@{i.version}] {i.worker.status()}")
         return plugins
 
+    def get_plugin_stats(self, plugin_id=None):
+        """
+            latency statistics of events of plugin, all plugins if plugin_id is None
+        """
+        if plugin_id is not None:
+            if plugin_id not in self.plugins.keys():
+                return None
+            return self.plugins[plugin_id].stats.to_dict()
+        return {i.id: i.stats.to_dict() for i in self.plugins.values()}
+
     async def check_not_load_plugins(self):
         cache_list = await self.__get_plugin_path_list()
         for i in self.plugins.values():
@@ -158,29 +243,47 @@ class PluginManager:
                 self.server.deregister_help_msg(plugin.id)
                 self.logger.info(f"Reload plugin {plugin.id}@{plugin.version}")
                 try:
-                    plugin.reload()
+                    if plugin.host is not None:
+                        await plugin.start_host()
+                    else:
+                        plugin.reload()
                 except Exception:
                     self.logger.info(f"Fail to Load plugin {plugin_file_name}")
                     return False
+                self.event_manager.register_plugin(plugin)
                 await self.plugin_run_event("on_load", plugin.id)
                 return True
             else:
                 return None
         else:
             try:
-                plugin = Plugin(self.logger, plugin_path, plugin_file_name[:-3])
-                if plugin.id in self.plugins.keys():
-                    self.logger.error(f"Fail to load plugin: {plugin_file_name}, duplicate id: '{plugin.id}'")
-                    return False
-                self.logger.info(f"Load plugin {plugin.id}@{plugin.version}")
-                self.plugin_dir.update({plugin_file_name: plugin.id})
-                self.event_manager.register_plugin(plugin)
-                self.plugins[plugin.id] = plugin
-                await self.plugin_run_event("on_load", plugin.id)
-                return True
+                plugin = Plugin(self.logger, plugin_path, plugin_file_name[:-3], self.server.config.plugin)
             except Exception:
                 self.logger.info(f"Fail to Load plugin {plugin_file_name}")
                 return False
+            return await self.__add_plugin(plugin, plugin_file_name)
+
+    async def __add_plugin(self, plugin: Plugin, plugin_file_name):
+        if plugin.id in self.plugins.keys():
+            self.logger.error(f"Fail to load plugin: {plugin_file_name}, duplicate id: '{plugin.id}'")
+            return False
+        missing = [i for i in plugin.dependencies if i not in self.plugins.keys()]
+        if len(missing) != 0:
+            self.logger.error(f"Fail to load plugin: {plugin_file_name}, missing dependencies: {missing}")
+            return False
+        try:
+            if plugin.host is not None:
+                await plugin.start_host()
+        except Exception:
+            self.logger.info(f"Fail to Load plugin {plugin_file_name}")
+            return False
+        self.logger.info(f"Load plugin {plugin.id}@{plugin.version}")
+        plugin.stats = self.stats.setdefault(plugin.id, PluginStats())
+        self.plugin_dir.update({plugin_file_name: plugin.id})
+        self.event_manager.register_plugin(plugin)
+        self.plugins[plugin.id] = plugin
+        await self.plugin_run_event("on_load", plugin.id)
+        return True
 
     async def unload_plugin(self, plugin_id, nursery=None):
         if plugin_id in self.plugins.keys():
@@ -227,12 +330,80 @@ class PluginManager:
             return False
 
     async def load_all_plugins(self):
+        """
+            import plugins in threads, then load them at the same time, each one after its dependencies
+        """
         self.logger.debug("Start load plugins", module="plugin")
-        plugins = await self.__get_plugin_path_list()
-        for i in plugins:
-            await self.__load_plugin(i, os.path.basename(i))
+        start = trio.current_time()
+        paths = []
+        for i in await self.__get_plugin_path_list():
+            if os.path.basename(i) in self.plugin_dir.keys():
+                await self.__load_plugin(i, os.path.basename(i))
+            else:
+                paths.append(i)
+        imported = {}
+        async with trio.open_nursery() as nursery:
+            for i in paths:
+                nursery.start_soon(self.__import_plugin, i, imported)
+        plugins = self.__sort_plugins([imported[i] for i in paths if i in imported.keys()])
+        loaded = {i.id: trio.Event() for i in plugins}
+        load_time = {}
+        async with trio.open_nursery() as nursery:
+            for plugin in plugins:
+                nursery.start_soon(self.__load_after_dependencies, plugin, loaded, load_time)
+        times = ", ".join(f"{i} {load_time[i]}ms" for i in sorted(load_time, key=load_time.get, reverse=True))
+        self.logger.info(f"Loaded {len(load_time)} plugins in {round((trio.current_time() - start) * 1000)}ms: {times}")
         self.logger.debug("Finish load plugins", module="plugin")
 
+    async def __import_plugin(self, plugin_path, imported: dict):
+        start = trio.current_time()
+        plugin_file_name = os.path.basename(plugin_path)
+        try:
+            plugin = await trio.to_thread.run_sync(
+                Plugin, self.logger, plugin_path, plugin_file_name[:-3], self.server.config.plugin)
+        except Exception:
+            self.logger.info(f"Fail to Load plugin {plugin_file_name}")
+            return
+        plugin.import_time = trio.current_time() - start
+        imported[plugin_path] = plugin
+
+    def __sort_plugins(self, plugins: list):
+        """
+            plugins in order of dependencies, without plugins with duplicate id, missing or circular dependencies
+        """
+        plugin_ids = {}
+        for plugin in plugins:
+            if plugin.id in plugin_ids.keys() or plugin.id in self.plugins.keys():
+                self.logger.error(f"Fail to load plugin: {os.path.basename(plugin.path_name)}, duplicate id: '{plugin.id}'")
+            else:
+                plugin_ids[plugin.id] = plugin
+        result = []
+        sorted_ids = set(self.plugins.keys())
+        while True:
+            ready = [i for i in plugin_ids.values() if all(j in sorted_ids for j in i.dependencies)]
+            if len(ready) == 0:
+                break
+            for plugin in ready:
+                plugin_ids.pop(plugin.id)
+                sorted_ids.add(plugin.id)
+                result.append(plugin)
+        for plugin in plugin_ids.values():
+            missing = [i for i in plugin.dependencies if i not in sorted_ids]
+            self.logger.error(f"Fail to load plugin: {os.path.basename(plugin.path_name)}, "
+                              f"missing or circular dependencies: {missing}")
+        return result
+
+    async def __load_after_dependencies(self, plugin: Plugin, loaded: dict, load_time: dict):
+        try:
+            for i in plugin.dependencies:
+                if i in loaded.keys():
+                    await loaded[i].wait()
+            start = trio.current_time()
+            if await self.__add_plugin(plugin, os.path.basename(plugin.path_name)):
+                load_time[plugin.id] = round((plugin.import_time + trio.current_time() - start) * 1000, 1)
+        finally:
+            loaded[plugin.id].set()
+
     async def unload_all_plugins(self):
         self.logger.debug("Start unload plugins", module="plugin")
         self.event_manager.unloading = True
@@ -243,6 +414,10 @@ class PluginManager:
         self.logger.debug("Finish unload plugins", module="plugin")
 
     async def check_reload_all_plugins(self):
+        async with self.reload_lock:
+            return await self.__check_reload_all_plugins()
+
+    async def __check_reload_all_plugins(self):
         cache_plugin = list(self.plugin_dir.keys())
         cache_list = await self.__get_plugin_path_list()
         load_plugins = 0
@@ -274,14 +449,51 @@ class PluginManager:
                 failed_plugin += 1
         return load_plugins, unload_plugins, reloaded_plugins, failed_plugin, len(self.plugins)
 
+    async def reload_changed_plugins(self, file_names):
+        """
+            load, reload or unload only the given files in plugins folder, used by PluginWatcher
+        """
+        load_plugins = 0
+        unload_plugins = 0
+        reloaded_plugins = 0
+        failed_plugin = 0
+        async with self.reload_lock:
+            for name in file_names:
+                path = "./plugins/" + name
+                if not os.path.isfile(path):
+                    if name in self.plugin_dir.keys():
+                        await self.unload_plugin(self.plugin_dir[name])
+                        unload_plugins += 1
+                    continue
+                loaded = name in self.plugin_dir.keys()
+                self.logger.debug(f"Check reload of {name}", "plugin")
+                result = await self.__load_plugin(path, name)
+                if result is None:
+                    continue
+                elif not result:
+                    if loaded:
+                        await self.__remove_plugin(name, self.plugin_dir[name])
+                    failed_plugin += 1
+                elif loaded:
+                    reloaded_plugins += 1
+                else:
+                    load_plugins += 1
+        return load_plugins, unload_plugins, reloaded_plugins, failed_plugin, len(self.plugins)
+
     async def __remove_plugin(self, plugin_file_name, plugin_id):
         self.event_manager.remove_plugin(self.plugin_dir[plugin_file_name])
+        if self.plugins[plugin_id].host is not None:
+            await self.plugins[plugin_id].host.stop()
         self.server.deregister_help_msg(plugin_id)
         self.plugin_dir.pop(plugin_file_name)
         self.plugins.pop(plugin_id)
         self.logger.info(f"Unload plugin {plugin_file_name}")
 
     async def run_event(self, event, *args, wait_time=1, nursery=None):
+        if nursery is None:
+            nursery = self.server.nursery
+        if not self.event_manager.is_subscribed(event):
+            return
         if nursery is None:
             self.logger.debug("no nursery exist, spawn nursery now", "CBR")
             async with trio.open_nursery() as nursery:
@@ -1,68 +1,228 @@
 """
     event
 """
+import inspect
 import trio
 
 from typing import TYPE_CHECKING
 
 from cbr.lib.logger import CBRLogger
-from cbr.plugin.cbrinterface import CBRInterface
+from cbr.plugin.cbrinterface import AsyncCBRInterface, CBRInterface
+from cbr.plugin.router import MessageRouter
+from cbr.plugin.stats import EventStats
 
 if TYPE_CHECKING:
+    from cbr.plugin.info import MessageInfo
     from cbr.plugin.plugin import Plugin
     from cbr.net.tcpserver import CBRTCPServer
 
 
+class PluginWorker:
+    """
+        Threads of sync events of one plugin, a plugin blocking in its events can only use its own threads
+
+        runaway is the amount of events still running after wait_time, both sync and async
+    """
+    def __init__(self, max_threads, max_queued):
+        self.limiter = trio.CapacityLimiter(max_threads)
+        self.max_queued = max_queued
+        # sync events running or waiting for a thread, and events waiting for the process of plugin with isolation
+        self.pending = 0
+        self.runaway = 0
+        self.dropped = 0
+
+    def set_max_threads(self, max_threads):
+        self.limiter.total_tokens = max_threads
+
+    def is_full(self):
+        return self.pending >= self.limiter.total_tokens + self.max_queued
+
+    def status(self):
+        statistics = self.limiter.statistics()
+        msg = f"threads: {statistics.borrowed_tokens}/{statistics.total_tokens}"
+        if statistics.tasks_waiting != 0:
+            msg += f", queued: {statistics.tasks_waiting}"
+        if self.runaway != 0:
+            msg += f", runaway: {self.runaway}"
+        if self.dropped != 0:
+            msg += f", dropped: {self.dropped}"
+        return msg
+
+
+# events with MessageInfo as the first argument, routed with message_filter of plugins
+ROUTED_EVENTS = ["on_message"]
+# events that plugins with priority run one by one, until the message is cancelled
+CHAIN_EVENTS = ["on_message", "on_command"]
+# events that wait for a thread even if the plugin is full, a plugin must not miss them
+LIFECYCLE_EVENTS = ["on_load", "on_unload"]
+
+
+class EventHandler:
+    """
+        Function of a plugin for one event, resolved when the plugin is loaded instead of every event
+    """
+    def __init__(self, plugin: "Plugin", run):
+        self.plugin = plugin
+        self.run = run
+        self.is_async = inspect.iscoroutinefunction(run)
+        # events of plugin in its own process wait for the process one by one, so they are bounded like sync events
+        self.is_bounded = not self.is_async or plugin.host is not None
+        # None for observers, which run at the same time without order
+        self.priority = plugin.priority
+
+
 class PluginEvent:
     def __init__(self, server: "CBRTCPServer", event, logger: CBRLogger):
         self.event = event
         self.logger = logger
         self.server = server
         self.register_event_plugins = {}
+        # dispatch table, rebuilt only when plugins are registered or removed
+        self.handlers = ()
+        self.router = None
 
     def register_all_plugins(self, plugin_dict):
         self.register_event_plugins = {}
+        self.__compile()
         for i in plugin_dict:
             plugin: "Plugin" = plugin_dict[i]
             self.register_plugin(plugin)
 
     def register_plugin(self, plugin: "Plugin"):
         if hasattr(plugin.instance, self.event):
-            self.register_event_plugins.update({plugin.id: plugin})
+            self.register_event_plugins.update({plugin.id: EventHandler(plugin, getattr(plugin.instance, self.event))})
             self.logger.debug(f"Plugin {plugin.id} register to event {self.event}", "plugin")
+        elif plugin.id in self.register_event_plugins.keys():
+            # the event is removed from the reloaded plugin
+            self.register_event_plugins.pop(plugin.id)
+        self.__compile()
 
     def remove_plugin(self, plugin_id):
         if plugin_id in self.register_event_plugins.keys():
             self.register_event_plugins.pop(plugin_id)
+            self.__compile()
             self.logger.debug(f"Plugin '{plugin_id}' removed in event '{self.event}'", "plugin")
 
+    def __compile(self):
+        handlers = list(self.register_event_plugins.values())
+        if self.event in CHAIN_EVENTS:
+            # chain by priority first, sort is stable so same priority keeps the order of registration
+            handlers.sort(key=lambda i: (i.priority is None, i.priority or 0))
+        self.handlers = tuple(handlers)
+        if self.event in ROUTED_EVENTS:
+            self.router = MessageRouter(self.handlers)
+
     async def plugins_run_event(self, wait_time, nursery, *args):
-        self.logger.debug(f"Start '{self.event}'", module="plugin")
+        if self.router is None:
+            handlers = self.handlers
+        else:
+            handlers = self.router.select(args[0])
+        if len(handlers) == 0:
+            return
+        if len(handlers) == 1:
+            await self.wait_run(handlers[0], nursery, wait_time, *args)
+            return
         async with trio.open_nursery() as nursery2:
-            for i in self.register_event_plugins:
-                plugin: "Plugin" = self.register_event_plugins[i]
-                run = getattr(plugin.instance, self.event)
-                nursery2.start_soon(self.wait_run, plugin.id, run, nursery, wait_time, *args)
-        self.logger.debug(f"Finish event '{self.event}'", module="plugin")
-
-    async def wait_run(self, plugin_id, run, nursery, wait_time=1, *args):
-        self.logger.debug(f"Start '{self.event}' of {plugin_id}", module="plugin")
-        server_interface = CBRInterface(self.server, self.server.token, plugin_id)
+            chain = []
+            for handler in handlers:
+                if handler.priority is not None and self.event in CHAIN_EVENTS:
+                    chain.append(handler)
+                else:
+                    nursery2.start_soon(self.wait_run, handler, nursery, wait_time, *args)
+            if len(chain) != 0:
+                await self.__run_chain(chain, nursery, wait_time, *args)
+
+    async def __run_chain(self, chain: list, nursery, wait_time, info: "MessageInfo", *args):
+        for i, handler in enumerate(chain):
+            await self.wait_run(handler, nursery, wait_time, info, *args)
+            if not info.is_send_message():
+                if i + 1 < len(chain):
+                    self.logger.debug(f"'{self.event}' cancelled by {handler.plugin.id}, skip {len(chain) - i - 1} plugins", "plugin")
+                return
+
+    async def wait_run(self, handler: EventHandler, nursery, wait_time=1, *args):
+        """
+            `async def` event runs in the trio loop, the others run in threads of the plugin
+
+            both are run in nursery, so it keeps running in background after wait_time
+        """
+        plugin = handler.plugin
+        run = handler.run
+        is_async = handler.is_async
+        worker: PluginWorker = plugin.worker
+        if handler.is_bounded and worker.is_full() and self.event not in LIFECYCLE_EVENTS:
+            worker.dropped += 1
+            busy = f"All threads of {plugin.id} are" if plugin.host is None else f"Process of {plugin.id} is"
+            self.logger.warning(f"{busy} busy, '{self.event}' dropped")
+            return
+        self.logger.debug(f"Start '{self.event}' of {plugin.id}", module="plugin")
+        done = trio.Event()
+        stats = plugin.stats.get(self.event)
+        if handler.is_bounded:
+            worker.pending += 1
+        if is_async:
+            nursery.start_soon(self.__run_async, worker if handler.is_bounded else None, run, done, stats, plugin.async_interface, *args)
+        else:
+            nursery.start_soon(self.__run_thread, worker, run, done, stats, plugin.interface, *args)
         if wait_time == -1:
-            cancel_scope = trio.CancelScope()
+            await done.wait()
         else:
-            cancel_scope = trio.move_on_after(wait_time)
-        with cancel_scope:
-            nursery.start_soon(trio.to_thread.run_sync, self.__run, run, cancel_scope, server_interface, *args)
-            await trio.sleep_forever()
-        self.logger.debug(f"Finish '{self.event}' of {plugin_id}", module="plugin")
+            with trio.move_on_after(wait_time):
+                await done.wait()
+        if not done.is_set():
+            stats.add_timeout()
+            self.logger.warning(f"'{self.event}' of {plugin.id} is still running after {wait_time}s")
+            nursery.start_soon(self.__wait_runaway, worker, done)
+        self.logger.debug(f"Finish '{self.event}' of {plugin.id}", module="plugin")
+
+    @staticmethod
+    async def __wait_runaway(worker: PluginWorker, done: trio.Event):
+        worker.runaway += 1
+        try:
+            await done.wait()
+        finally:
+            worker.runaway -= 1
+
+    @staticmethod
+    def __latency(start):
+        return round((trio.current_time() - start) * 1000, 3)
 
-    def __run(self, run_plugin, cancel_scope: trio.CancelScope, server_interface: CBRInterface, *args):
+    async def __run_async(self, worker: PluginWorker, run_plugin, done: trio.Event, stats: EventStats, server_interface: AsyncCBRInterface, *args):
+        """
+            worker is None if the event is not counted in pending of the worker
+        """
+        start = trio.current_time()
+        error = False
+        try:
+            await run_plugin(server_interface, *args)
+        except Exception:
+            error = True
+            self.logger.bug()
+        finally:
+            if worker is not None:
+                worker.pending -= 1
+            done.set()
+        stats.add(self.__latency(start), error)
+
+    async def __run_thread(self, worker: PluginWorker, run_plugin, done: trio.Event, stats: EventStats, server_interface: CBRInterface, *args):
+        start = trio.current_time()
+        try:
+            error = await trio.to_thread.run_sync(self.__run, run_plugin, server_interface, *args, limiter=worker.limiter)
+        finally:
+            worker.pending -= 1
+            done.set()
+        stats.add(self.__latency(start), error)
+
+    def __run(self, run_plugin, server_interface: CBRInterface, *args):
+        """
+            return True if there is any error
+        """
         try:
             run_plugin(server_interface, *args)
         except Exception:
             self.logger.bug()
-        trio.from_thread.run_sync(cancel_scope.cancel)
+            return True
+        return False
 
 
 class PluginEventManager:
@@ -86,11 +246,20 @@ class PluginEventManager:
         self.events.update({event: PluginEvent(self.server, event, self.logger)})
 
     def register_plugins(self, plugin_dict):
+        for i in plugin_dict.values():
+            self.__create_interface(i)
         for i in self.events:
             event: PluginEvent = self.events[i]
             event.register_all_plugins(plugin_dict)
 
+    def __create_interface(self, plugin: "Plugin"):
+        # interfaces keep nothing of an event, so they are shared by all events of the plugin
+        if plugin.interface is None:
+            plugin.interface = CBRInterface(self.server, self.server.token, plugin.id)
+            plugin.async_interface = AsyncCBRInterface(self.server, plugin.id)
+
     def register_plugin(self, plugin: "Plugin"):
+        self.__create_interface(plugin)
         for i in self.events:
             event: PluginEvent = self.events[i]
             event.register_plugin(plugin)
@@ -99,10 +268,15 @@ class PluginEventManager:
         for i in self.events:
             self.events[i].remove_plugin(plugin_id)
 
+    def is_subscribed(self, event):
+        return event in self.events.keys() and len(self.events[event].handlers) != 0
+
     async def run_event(self, event, wait_time, nursery, *args):
         if event not in self.events:
             self.logger.error(f"Event '{event}' haven't been register")
             return
+        if len(self.events[event].handlers) == 0:
+            return
         if self.unloading and event != "on_unload":
             self.logger.warning(f"Plugin unloading, event '{event}' skipped")
             return
@@ -116,6 +290,5 @@ class PluginEventManager:
             self.logger.warning(f"Plugin unloading, event '{event}' skipped")
             return
         if plugin_id in self.events[event].register_event_plugins.keys():
-            plugin: "Plugin" = self.events[event].register_event_plugins[plugin_id]
-            run = getattr(plugin.instance, event)
-            await self.events[event].wait_run(plugin_id, run, nursery, wait_time=wait_time, *args)
+            handler: EventHandler = self.events[event].register_event_plugins[plugin_id]
+            await self.events[event].wait_run(handler, nursery, wait_time, *args)
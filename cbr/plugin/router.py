@@ -0,0 +1,104 @@
+"""
+    route messages to plugins with message_filter in METADATA
+"""
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from cbr.plugin.info import MessageInfo
+    from cbr.plugin.plugin_event import EventHandler
+
+
+class MessageFilter:
+    """
+        message_filter in METADATA, like {"prefixes": ["##list"], "client_type": ["mc"], "source_client": ["survival"], "player_only": True}
+
+        every key is optional, message must match all of them, and any one of the prefixes
+    """
+    def __init__(self, data: dict):
+        self.prefixes = tuple(str(i) for i in self.__to_list(data.get("prefixes")) or ())
+        self.client_types = self.__to_list(data.get("client_type"))
+        self.source_clients = self.__to_list(data.get("source_client"))
+        self.player_only = bool(data.get("player_only", False))
+
+    @staticmethod
+    def __to_list(value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            return [value]
+        return list(value)
+
+    def match(self, info: "MessageInfo"):
+        """
+            check everything except prefixes, which are checked by the trie
+        """
+        if self.client_types is not None and info.client_type not in self.client_types:
+            return False
+        if self.source_clients is not None and info.source_client not in self.source_clients:
+            return False
+        if self.player_only and not info.sender:
+            return False
+        return True
+
+
+class TrieNode:
+    def __init__(self):
+        self.children = {}
+        self.handlers = []
+
+
+class PrefixTrie:
+    def __init__(self):
+        self.root = TrieNode()
+
+    def add(self, prefix, handler):
+        node = self.root
+        for char in prefix:
+            node = node.children.setdefault(char, TrieNode())
+        node.handlers.append(handler)
+
+    def find(self, text):
+        """
+            handlers of all prefixes of text
+        """
+        node = self.root
+        result = list(node.handlers)
+        for char in text:
+            node = node.children.get(char)
+            if node is None:
+                break
+            result.extend(node.handlers)
+        return result
+
+
+class MessageRouter:
+    """
+        Select the handlers of a message, plugins without message_filter get every message
+    """
+    def __init__(self, handlers: tuple):
+        self.handlers = handlers
+        self.catch_all = []
+        self.filtered = []
+        self.trie = PrefixTrie()
+        for handler in handlers:
+            message_filter = handler.plugin.message_filter
+            if message_filter is None:
+                self.catch_all.append(handler)
+            elif len(message_filter.prefixes) == 0:
+                self.filtered.append(handler)
+            else:
+                for prefix in set(message_filter.prefixes):
+                    self.trie.add(prefix, handler)
+
+    def select(self, info: "MessageInfo"):
+        if len(self.catch_all) == len(self.handlers):
+            return self.handlers
+        selected = set(self.catch_all)
+        for handler in self.filtered:
+            if handler.plugin.message_filter.match(info):
+                selected.add(handler)
+        for handler in self.trie.find(info.content):
+            if handler not in selected and handler.plugin.message_filter.match(info):
+                selected.add(handler)
+        # keep the order of registration
+        return tuple(i for i in self.handlers if i in selected)
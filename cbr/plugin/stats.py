@@ -0,0 +1,88 @@
+"""
+    latency of plugin events, collected in PluginEvent.wait_run
+"""
+from bisect import bisect_left
+from collections import deque
+
+# upper bound(ms) of each bucket in histogram, the last bucket is for the rest
+LATENCY_BUCKETS = [1, 5, 10, 50, 100, 500, 1000, 5000]
+# percentiles are calculated from the latest samples
+RECENT_SAMPLES = 1024
+
+
+class EventStats:
+    """
+        Latency(ms) of one event of one plugin, from the event is dispatched to the function returns
+    """
+    def __init__(self):
+        self.calls = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.max = 0
+        self.total = 0
+        self.recent = deque(maxlen=RECENT_SAMPLES)
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, latency, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.max = max(self.max, latency)
+        self.total += latency
+        self.recent.append(latency)
+        self.histogram[bisect_left(LATENCY_BUCKETS, latency)] += 1
+
+    def add_timeout(self):
+        self.timeouts += 1
+
+    def percentile(self, percent):
+        if len(self.recent) == 0:
+            return None
+        samples = sorted(self.recent)
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def text(self):
+        return (f"calls = {self.calls}, p50 = {self.percentile(50)}ms, p95 = {self.percentile(95)}ms, "
+                f"p99 = {self.percentile(99)}ms, max = {self.max}ms, timeouts = {self.timeouts}, errors = {self.errors}")
+
+    def to_dict(self):
+        return {
+            "calls": self.calls,
+            "timeouts": self.timeouts,
+            "errors": self.errors,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+            "avg": round(self.total / self.calls, 3) if self.calls != 0 else None,
+            "histogram": dict(zip([str(i) for i in LATENCY_BUCKETS] + ["inf"], self.histogram))
+        }
+
+
+class PluginStats:
+    """
+        EventStats of all events of one plugin, kept after the plugin is reloaded
+    """
+    def __init__(self):
+        self.events = {}
+
+    def get(self, event) -> EventStats:
+        if event not in self.events.keys():
+            self.events[event] = EventStats()
+        return self.events[event]
+
+    def summary_text(self):
+        stats = list(self.events.values())
+        calls = sum(i.calls for i in stats)
+        slowest = max((i.max for i in stats), default=0)
+        timeouts = sum(i.timeouts for i in stats)
+        errors = sum(i.errors for i in stats)
+        return f"calls = {calls}, max = {slowest}ms, timeouts = {timeouts}, errors = {errors}"
+
+    def text(self):
+        if len(self.events) == 0:
+            return "No event called"
+        return "\n".join(f"- {event}: {stats.text()}" for event, stats in self.events.items())
+
+    def to_dict(self):
+        return {event: stats.to_dict() for event, stats in self.events.items()}
@@ -0,0 +1,163 @@
+"""
+    watch the plugins folder and reload the changed plugins, with inotify on linux or polling
+"""
+import ctypes
+import ctypes.util
+import os
+import struct
+import trio
+
+from cbr.lib.logger import CBRLogger
+
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from cbr.plugin.plugin import PluginManager
+
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """
+        inotify of one folder with ctypes, OSError if it is not available
+    """
+    def __init__(self, path):
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError, TypeError):
+            raise OSError("inotify not available")
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch of {path} failed")
+
+    async def read(self):
+        """
+            wait for events and return names of changed files, None if events are lost
+        """
+        await trio.lowlevel.wait_readable(self.fd)
+        names = set()
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return names
+            offset = 0
+            while offset < len(data):
+                _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size
+                if mask & IN_Q_OVERFLOW:
+                    return None
+                names.add(os.fsdecode(data[offset:offset + length].rstrip(b"\0")))
+                offset += length
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PluginWatcher:
+    """
+        Reload plugins in the folder once their files have not changed for debounce seconds
+
+        only the changed, added or removed files are reloaded, instead of checking every plugin
+    """
+    def __init__(self, plugin_manager: "PluginManager", logger: CBRLogger, plugin_config: dict, path="./plugins"):
+        self.plugin_manager = plugin_manager
+        self.logger = logger
+        self.path = path
+        self.enabled = plugin_config["auto_reload"]
+        self.interval = plugin_config["watch_interval"]
+        self.debounce = plugin_config["watch_debounce"]
+        # file name -> last time it changed
+        self.pending = {}
+        self.wakeup = trio.Event()
+        self.snapshot = {}
+
+    async def run(self):
+        if not self.enabled:
+            return
+        try:
+            inotify = Inotify(self.path)
+        except OSError as e:
+            self.logger.debug(f"Watch plugins by polling every {self.interval}s, {e}", "plugin")
+            inotify = None
+        try:
+            async with trio.open_nursery() as nursery:
+                if inotify is not None:
+                    nursery.start_soon(self.__watch_inotify, inotify)
+                else:
+                    nursery.start_soon(self.__watch_poll)
+                nursery.start_soon(self.__reload_loop)
+        finally:
+            if inotify is not None:
+                inotify.close()
+
+    def mark(self, name):
+        if name.endswith(".py"):
+            self.pending[name] = trio.current_time()
+            self.wakeup.set()
+
+    async def __watch_inotify(self, inotify: Inotify):
+        self.logger.debug("Watch plugins with inotify", "plugin")
+        self.snapshot = self.__scan()
+        while True:
+            names = await inotify.read()
+            if names is None:
+                # queue overflowed, find the changes from the folder
+                self.__mark_changes()
+                continue
+            for name in names:
+                self.mark(name)
+
+    async def __watch_poll(self):
+        self.snapshot = self.__scan()
+        while True:
+            await trio.sleep(self.interval)
+            self.__mark_changes()
+
+    def __scan(self):
+        snapshot = {}
+        try:
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".py") and entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.name] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            self.logger.bug(error=False)
+        return snapshot
+
+    def __mark_changes(self):
+        snapshot = self.__scan()
+        for name in snapshot.keys() | self.snapshot.keys():
+            if snapshot.get(name) != self.snapshot.get(name):
+                self.mark(name)
+        self.snapshot = snapshot
+
+    async def __reload_loop(self):
+        while True:
+            if len(self.pending) == 0:
+                await self.wakeup.wait()
+                self.wakeup = trio.Event()
+                continue
+            now = trio.current_time()
+            ready = [name for name, changed in self.pending.items() if now - changed >= self.debounce]
+            if len(ready) == 0:
+                await trio.sleep(min(self.pending.values()) + self.debounce - now)
+                continue
+            for name in ready:
+                self.pending.pop(name)
+            loaded, unloaded, reloaded, failed, num = await self.plugin_manager.reload_changed_plugins(ready)
+            if loaded + unloaded + reloaded + failed != 0:
+                self.logger.info(f"Auto reload plugins: {loaded} loaded, {unloaded} unloaded, "
+                                 f"{reloaded} reloaded, {failed} failed, {num} plugins in total")
@@ -1,6 +1,3 @@
-import json
-
-
 def info_formatter(client, player, msg):
     if player != "":
         message = f"[{client}] <{player}> {msg}"  # chat message
@@ -18,7 +15,7 @@ def message_formatter(client, player, msg, receiver=""):
        }
     if receiver != "":
         message.update({"receiver": receiver})
-    return json.dumps(message)
+    return message
 
 
 def ping_formatter(pong=False):
@@ -30,10 +27,10 @@ def ping_formatter(pong=False):
         "action": "keepAlive",
         "type": action_type
     }
-    return json.dumps(message)
+    return message
 
 
-def login_formatter(success=True):
+def login_formatter(success=True, capabilities: dict = None):
     if success:
         action_result = "login success"
     else:
@@ -42,10 +39,22 @@ def login_formatter(success=True):
         "action": "result",
         "result": action_result
     }
-    return json.dumps(message)
+    if capabilities is not None:
+        message.update({"capabilities": capabilities})
+    return message
+
 
+def stop_formatter():
+    message = {"action": "stop"}
+    return message
+
+
+def batch_formatter(msgs: list):
+    # msgs are json strings already, join them instead of dumps again
+    return '{"action": "batch", "messages": [' + ", ".join(msgs) + "]}"
 
-def command_formatter(cmd, receiver):
+
+def command_formatter(cmd, receiver, request_id=None):
     message = {
         "action": "command",
         "sender": "CBR",
@@ -56,10 +65,12 @@ def command_formatter(cmd, receiver):
             "responded": False
         }
     }
-    return json.dumps(message)
+    if request_id is not None:
+        message["id"] = request_id
+    return message
 
 
-def api_formatter(receiver, plugin_id, function_name, keys: dict):
+def api_formatter(receiver, plugin_id, function_name, keys: dict, request_id=None):
     message = {
         "action": "api",
         "sender": "CBR",
@@ -72,7 +83,9 @@ def api_formatter(receiver, plugin_id, function_name, keys: dict):
             "responded": False
         }
     }
-    return json.dumps(message)
+    if request_id is not None:
+        message["id"] = request_id
+    return message
 
 
 def no_color_formatter(msg):
@@ -23,10 +23,46 @@ json格式：
     "password": "ClientPassword"
     "lib_version" : "Version"
     "type" : "ClientType"
+    "capabilities": // 可选, 客户端支持的功能
+    {
+        "batch": true,
+        "protocol": 2,
+        "keepalive": true, // 可选, 按服务端给的间隔发送 ping
+        "compression": ["zlib"], // 可选, 支持的压缩方式
+        "cipher": ["cbc", "ctr-hmac"] // 可选, 支持的加密方式
+    }
 }
 返回登录情况：server -> client 返回结果
     "result": login success" // 成功
     "result": login fail" // 失败
+    "capabilities": {...} // 可选, 服务端与客户端都支持的功能, 没有的功能不可以使用
+    // compression: {"codec": "zlib", "level": 6, "threshold": 256}, 只在协议 v2 使用, 大于 threshold 的 body 才压缩
+    // cipher: "ctr-hmac", 只在协议 v2 使用, 没有时为 "cbc", 登录之后双方只接受此加密方式的数据包 (ctr-hmac 时也不接受 v1)
+    // keepalive: {"interval": 15, "timeout": 90}, 每 interval 秒发送 ping, timeout 秒没有收到任何数据包即断开连接
+
+协议 v2： 登录结果的 capabilities 中 "protocol" 为 2 之后使用, 接收方会按第一个 byte 判断 v1 或 v2
+4 byte长的unsigned int代表长度, 随后是:
+    1 byte magic: 0xCB // v1 的 base64 或 json 不会以此开头
+    1 byte flags: 0x01 = body 已加密, bit 1-2 = body 的压缩方式 (0 无, 1 zlib, 2 zstd), 先压缩再加密
+        0x08 = ctr-hmac 加密, body 为 12 byte nonce + AES-CTR 密文 + 16 byte HMAC-SHA256 (包括 body 之前的所有 byte)
+        0x10 = command 或 api 的回复 (result.responded 为 true), 服务端可以不解密直接转发给 sender
+    1 byte action: 0 其他 json, 1 result, 2 message, 3 ping, 4 pong, 5 stop, 6 command, 7 api, 8 batch
+    1 byte 字段数量
+    字段: 2 byte长的unsigned short代表长度, 随后是 utf-8 字符串 // command 与 api 为 sender, receiver
+    body: 剩余部分, 为 json (不经过 base64), ping 与 pong 没有 body, 但有密钥时同样要加密 (加密后的 body 为空)
+    batch 的 body 为多个 v2 数据包 (各自带 4 byte 长度), 整个 body 只加密一次, 里面的数据包除了转发的以外都不加密
+    有密钥时, 不在 batch 里面的数据包必须加密
+    数据包长度或解压后的长度大于 max_frame_size (默认 4194304) 时会直接断开连接
+
+批量传输： client <-> server, 需要双方都支持 batch
+{
+    "action": "batch",
+    "messages":
+    [
+        {...}, // 任意其他数据包
+        {...}
+    ]
+}
 
 传输信息： client <-> server
 {
@@ -54,6 +90,7 @@ receiver -> sender
     "type": "pong"
 }
 等待KeepAliveTimeWait秒无响应即可中断连接
+服务端只 ping 超过 keepalive_idle 秒没有发送任何数据包的客户端, 超过 keepalive_timeout 秒即断开连接
 
 调用指令：
 clientA -> server -> clientB
@@ -62,6 +99,7 @@ clientA -> server -> clientB
     "sender": "CLIENT_A_NAME",
     "receiver": "CLIENT_B_NAME",
     "command": "COMMAND",
+    "id": 1, // 可选, 请求 id, 回复时原样返回, 用于对应同时进行的多个请求
     "result":
     {
         "responded": false
@@ -103,6 +141,7 @@ clientA -> server -> clientB
         True // only support string and bool
         // must with order
     ]
+    "id": 1, // 可选, 与 command 相同
     "result":
     {
         "responded": false
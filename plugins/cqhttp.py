@@ -46,18 +46,17 @@ def check_start(msg):
 
 
 def custom_check_send(target, msg, client, player, server: CBRInterface):
-    cache_disable_duplicate_send = False
-    if target == 'full' and full_msg_group_client != []:
-        for i in full_msg_group_client:
-            if server.is_client_online(i):
-                server.send_custom_message(client, i, msg, player)
-                cache_disable_duplicate_send = disable_duplicate_send
-    elif target == 'less' and less_msg_group_client != []:
-        for i in less_msg_group_client:
-            if server.is_client_online(i):
-                server.send_custom_message(client, i, msg, player)
-                cache_disable_duplicate_send = disable_duplicate_send
-    return cache_disable_duplicate_send
+    if target == 'full':
+        group_client = full_msg_group_client
+    elif target == 'less':
+        group_client = less_msg_group_client
+    else:
+        return False
+    targets = [i for i in group_client if server.is_client_online(i)]
+    if targets == []:
+        return False
+    server.send_custom_messages(client, targets, msg, player)
+    return disable_duplicate_send
 
 
 def on_message(server: CBRInterface, info: MessageInfo):
@@ -69,8 +68,7 @@ def on_message(server: CBRInterface, info: MessageInfo):
                 msg = replace_message(msg)
                 servers = server.get_online_mc_clients()
                 server.logger.info(f"[{info.source_client}] <{info.sender}> {msg}")
-                for i in servers:
-                    server.send_custom_message(info.source_client, i, msg, info.sender)
+                server.send_custom_messages(info.source_client, servers, msg, info.sender)
         elif info.source_client not in full_msg_group_client:
             info.cancel_send_message()
     else:
@@ -3,7 +3,7 @@ test-plugin
 similar with MCDR
 """
 
-from cbr.plugin.cbrinterface import CBRInterface
+from cbr.plugin.cbrinterface import AsyncCBRInterface, CBRInterface
 from cbr.plugin.info import MessageInfo
 
 
@@ -13,7 +13,9 @@ METADATA = {
     'name': 'not_sample_plugin_xd',
     'description': '##list, it is not a sample plugin',
     'author': 'Ricky',
-    'link': 'https://github.com/R1ckyH/ChatBridgeReforged'
+    'link': 'https://github.com/R1ckyH/ChatBridgeReforged',
+    'message_filter': {'prefixes': ['##list', '##online']},  # on_message is only called with these messages
+    'priority': 1000  # plugins with larger priority are skipped if it cancels the message
 }
 
 
@@ -27,36 +29,22 @@ def players_no_bot(player_list):
     return player_string
 
 
-def list_player(server, info):
+async def list_player(server: AsyncCBRInterface, info: MessageInfo):
     if info.content == '##list' or info.content == "##online":
         info.cancel_send_message()
         online_mc_client = server.get_online_mc_clients()
-        players = {}
-        results = server.servers_command_query(online_mc_client, 'list')
-        if results is None:
-            server.reply(info, "No information")
-            return
-        for i in results.keys():
-            if results[i] is not None:
-                if results[i].startswith("Unknown command"):
-                    players.update({i: "Command Error"})
-                else:
-                    player_string = players_no_bot(results[i].split('online: ')[1].split(', '))
-                    players.update({i: player_string})
-            else:
-                players.update({i: "Command Failed"})
         message = "- Online players:"
-        for i in range(len(online_mc_client)):
-            message += f"\n§r[§6{online_mc_client[i]}§r] : {players[online_mc_client[i]]}"
-        server.reply(info, message)
+        for i in online_mc_client:
+            message += f"\n§r[§6{i}§r] : {players_no_bot(server.get_players(i))}"
+        await server.reply(info, message)
 
 
-def on_message(server: CBRInterface, info: MessageInfo):
-    list_player(server, info)
+async def on_message(server: AsyncCBRInterface, info: MessageInfo):  # async event runs without thread
+    await list_player(server, info)
 
 
-def on_command(server, info):  # not recommend doing, but you can do it
-    list_player(server, info)
+async def on_command(server: AsyncCBRInterface, info: MessageInfo):  # not recommend doing, but you can do it
+    await list_player(server, info)
 
 
 def on_load(server: CBRInterface):
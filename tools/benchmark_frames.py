@@ -0,0 +1,46 @@
+"""
+    compare legacy frame (zlib on ciphertext + base64) with protocol v2 (compress plaintext before encrypt) and its ciphers
+
+    run from the root of the repository: python tools/benchmark_frames.py [times]
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cbr.lib.logger import CBRLogger
+from cbr.net.encrypt import AESCryptor, CIPHER_CBC, CIPHER_CTR_HMAC
+from cbr.net.frame import encode_v2, FrameCompressor
+
+
+def benchmark(times=2000):
+    cryptor = AESCryptor("testing", CBRLogger("test"))
+    rtext = [{"text": f"[{i}] ", "color": "gray", "hoverEvent": {"action": "show_text", "contents": "click to copy"}} for i in range(40)]
+    samples = {
+        "chat": {"action": "message", "client": "survival", "player": "ricky", "message": "hello world"},
+        "rcon result": {"action": "command", "sender": "CBR", "receiver": "survival", "command": "list",
+                        "result": {"responded": True, "type": 0, "result": "Steve has the following entity data: " * 60}},
+        "rtext": {"action": "message", "client": "survival", "player": "", "message": json.dumps(rtext)}
+    }
+    cbc = cryptor.ciphers[CIPHER_CBC]
+    ctr = cryptor.ciphers[CIPHER_CTR_HMAC]
+    codecs = [("v1 legacy", None, None), ("v2 no compress", cbc, FrameCompressor("none"))]
+    codecs += [(f"v2 zlib {i}", cbc, FrameCompressor("zlib", i)) for i in (1, 6, 9)]
+    codecs += [("v2 ctr-hmac", ctr, FrameCompressor("none")), ("v2 ctr-hmac zlib", ctr, FrameCompressor("zlib", 6))]
+    for name, msg in samples.items():
+        print(f"{name}: {len(json.dumps(msg))} bytes of json")
+        for codec_name, cipher, compressor in codecs:
+            start = time.perf_counter()
+            for _ in range(times):
+                if compressor is None:
+                    frame = cryptor.encrypt(json.dumps(msg))
+                else:
+                    frame = encode_v2(msg, cipher, compressor)
+            cost = (time.perf_counter() - start) / times * 1000000
+            print(f"    {codec_name:<16}{len(frame):>8} bytes{cost:>10.1f} us")
+
+
+if __name__ == "__main__":
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)